@@ -1,38 +1,269 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
+from flask import (Flask, Blueprint, render_template, redirect, url_for, flash, request, jsonify, make_response, g,
+                   has_app_context, has_request_context, current_app, send_file, session, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField, SubmitField
 from wtforms.validators import DataRequired, Email, EqualTo, Length
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from datetime import datetime
+from sqlalchemy import bindparam, column, create_engine, delete, event, insert, table, text, tuple_, update
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from markupsafe import escape
+from datetime import datetime, timedelta
+import contextlib
+import functools
+import hashlib
+import math
 import os
-from dotenv import load_dotenv
+import random
+import re
+import threading
+import time
+from config import config, engine_options
+from local_broker import LocalBrokerManager
+from presence import PresenceRegistry
+from message_writer import MessageWriter
+from directory import DirectoryCache
+from user_cache import TTLCache
+from typing_state import TypingTracker
+from read_receipts import ReadReceiptBuffer
+from metrics import Registry
+from attachments import AttachmentStore, TooLarge
+from export import EXPORT_FORMATS, encode_export
+from rate_limit import RateLimiter, backend_from_url
+import passwords
+import serializer
 
-load_dotenv()
+# Extensions and per-process state are created unbound; create_app()
+# configures them once the configuration is complete
+class RoutingSession(Session):
+    """Sends reads to the read replica chosen for the request, if any
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
-database_url = os.environ.get('DATABASE_URL')
-if database_url and database_url.startswith('postgres://'):
-    database_url = database_url.replace('postgres://', 'postgresql://', 1)
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///chat.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    Views opt in with :func:`replica_reads`. Flushes and INSERT, UPDATE and
+    DELETE statements always go to the primary.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) and has_app_context():
+            replica = g.get('read_replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause, bind, **kwargs)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(json=serializer)
+main = Blueprint('main', __name__)
+presence = PresenceRegistry()
+read_receipts = ReadReceiptBuffer()
+# Keyed by (reader, conversation) instead of (reader, peer)
+group_read_receipts = ReadReceiptBuffer()
+typing_tracker = TypingTracker()
+
+# Metrics, served at /metrics
+metrics = Registry()
+http_requests = metrics.counter(
+    'http_requests', 'HTTP requests by endpoint and status', ('endpoint', 'method', 'status'))
+http_request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ('endpoint', 'method'))
+http_request_queries = metrics.histogram(
+    'http_request_sql_queries', 'SQL statements run per HTTP request', ('endpoint',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+http_request_sql_seconds = metrics.histogram(
+    'http_request_sql_duration_seconds', 'Time spent in SQL per HTTP request', ('endpoint',))
+sql_query_seconds = metrics.histogram('sql_query_duration_seconds', 'Latency of single SQL statements')
+socket_event_seconds = metrics.histogram(
+    'socketio_event_duration_seconds', 'Socket.IO handler latency; _count is the event count', ('event',))
+sockets_connected = metrics.gauge('socketio_connected_sockets', 'Sockets connected to this process')
+emit_fanout = metrics.histogram(
+    'socketio_emit_fanout_rooms', 'Rooms addressed by one server emit', ('event',),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+rate_limited = metrics.counter(
+    'rate_limited', 'Requests and socket events turned away by the rate limiter', ('name',))
+replica_routing = metrics.counter(
+    'db_replica_routing', 'Replica-eligible requests by where their reads went', ('target',))
+attachment_uploads = metrics.counter(
+    'attachment_uploads', 'Attachments uploaded, and whether their content was already stored', ('deduplicated',))
+
+def _room_counts():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    names = [room for room in rooms if isinstance(room, str)]
+    return {
+        ('user',): sum(1 for room in names if room.startswith('user_')),
+        ('conversation',): sum(1 for room in names if room.startswith('conversation_')),
+    }
+
+metrics.gauge('socketio_rooms', 'Rooms with members in this process', ('kind',), callback=_room_counts)
+metrics.gauge('presence_online_users', 'Users with a socket on this process',
+              callback=lambda: len(presence.online_user_ids()))
+metrics.gauge('message_writer_backlog', 'Messages waiting for the write-behind queue',
+              callback=lambda: message_writer.backlog())
+metrics.gauge('read_receipts_pending', 'Read watermarks waiting to be saved',
+              callback=lambda: len(read_receipts))
+metrics.counter('cache_hits', 'Cache hits', ('cache',), callback=lambda: {
+    ('user',): user_cache.hits, ('directory',): directory.hits})
+metrics.counter('cache_misses', 'Cache misses', ('cache',), callback=lambda: {
+    ('user',): user_cache.misses, ('directory',): directory.misses})
+metrics.counter('typing_events', 'Typing events by outcome', ('outcome',), callback=lambda: {
+    (outcome,): count for outcome, count in typing_tracker.stats().items()})
+
+def _pool_status():
+    pool = db.engine.pool
+    # Only queue-style pools (not SQLite's in-memory ones) keep these numbers
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    return {
+        ('size',): pool.size(),
+        ('checked_out',): pool.checkedout(),
+        ('checked_in',): pool.checkedin(),
+        ('overflow',): max(0, pool.overflow()),
+    }
+
+metrics.gauge('db_pool_connections', 'Database pool connections by state', ('state',), callback=_pool_status)
+db_pool_events = metrics.counter('db_pool_events', 'Connections opened, checked out and invalidated', ('event',))
+
+@event.listens_for(Pool, 'connect')
+def _count_pool_connect(dbapi_connection, connection_record):
+    db_pool_events.inc(event='connect')
+
+@event.listens_for(Pool, 'checkout')
+def _count_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    db_pool_events.inc(event='checkout')
+
+@event.listens_for(Pool, 'invalidate')
+def _count_pool_invalidate(dbapi_connection, connection_record, exception):
+    db_pool_events.inc(event='invalidate')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    sql_query_seconds.observe(elapsed)
+    if has_app_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+        if elapsed >= current_app.config['SLOW_QUERY_THRESHOLD']:
+            current_app.logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, statement)
+
+@main.before_app_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+# Rate limiting, by route endpoint or "socket.<event>"; budgets are in config.py
+rate_limiter = RateLimiter()
+
+def rate_limit_identity():
+    """Whose budget a call spends: the user's, or the client address before login
+
+    Read straight from the signed session cookie, so a rejected call costs
+    no user lookup.
+    """
+    user_id = session.get('_user_id')
+    return f'user:{user_id}' if user_id else f'ip:{request.remote_addr}'
+
+def check_rate_limit(name):
+    """Spend one call of ``name``; returns seconds to wait, 0 if the call may go ahead"""
+    if not current_app.config['RATELIMIT_ENABLED']:
+        return 0
+    try:
+        retry_after = rate_limiter.hit(name, rate_limit_identity())
+    except Exception:
+        # A limiter outage must not take the app down with it
+        current_app.logger.exception('Rate limit check failed; allowing %s', name)
+        return 0
+    if retry_after:
+        rate_limited.inc(name=name)
+    return retry_after
+
+@main.before_app_request
+def _share_presence():
+    # A worker without sockets still needs the other workers' presence
+    if current_app.config['PRESENCE_SHARED']:
+        ensure_background_task('presence', presence_worker)
+    # Another worker may add or remove members of this worker's groups
+    if current_app.config['SOCKETIO_MESSAGE_QUEUE']:
+        ensure_background_task('membership', membership_worker)
+
+@main.before_app_request
+def _enforce_rate_limit():
+    retry_after = check_rate_limit(request.endpoint or 'unmatched')
+    if retry_after:
+        if request.path.startswith('/api/'):
+            response = jsonify({'error': 'Too many requests', 'retry_after': retry_after})
+        else:
+            response = make_response('Too many requests, please try again shortly.')
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+
+@main.after_app_request
+def _record_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+    http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    http_request_queries.observe(g.get('sql_queries', 0), endpoint=endpoint)
+    http_request_sql_seconds.observe(g.get('sql_seconds', 0.0), endpoint=endpoint)
+    return response
+
+def socket_event(name):
+    """Register a Socket.IO handler like ``socketio.on``, rate limited and timed
+
+    A rate-limited event is dropped and answered with ``rate_limited``; a
+    rate-limited connection is refused.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                retry_after = check_rate_limit(f'socket.{name}')
+                if retry_after:
+                    if name == 'connect':
+                        return False
+                    limited = {'event': name, 'retry_after': retry_after}
+                    if args and isinstance(args[0], dict) and 'client_id' in args[0]:
+                        limited['client_id'] = args[0]['client_id']
+                    emit('rate_limited', limited)
+                    return
+                return handler(*args)
+            finally:
+                socket_event_seconds.observe(time.perf_counter() - started, event=name)
+        socketio.on(name)(timed)
+        return handler
+    return decorator
+
+# User loader for Flask-Login, backed by a cache of detached snapshots
+user_cache = TTLCache()
 
-# User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    snapshot = user_cache.get(user_id)
+    if snapshot is None:
+        with on_primary():
+            user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user)
+        user_cache.set(user_id, snapshot)
+    return snapshot
 
 # Database Models
 class User(UserMixin, db.Model):
@@ -50,40 +281,755 @@ class User(UserMixin, db.Model):
     received_messages = db.relationship('Message', foreign_keys='Message.recipient_id', backref='recipient', lazy='dynamic')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        self.password_hash = passwords.offload(socketio.async_mode, generate_password_hash, password, method)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify ``password`` off the event loop, upgrading an outdated hash on success"""
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        ok, new_hash = passwords.offload(socketio.async_mode, passwords.verify, self.password_hash, password, method)
+        if new_hash:
+            self.password_hash = new_hash
+        return ok
     
     def to_dict(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'email': self.email,
-            'avatar': self.avatar,
-            'status': self.status,
-            'is_online': self.is_online,
-            'last_seen': self.last_seen.isoformat() if self.last_seen else None
-        }
+        return dict(self.to_public_dict(), email=self.email)
+    
+    def to_public_dict(self):
+        """What other users may see: everything but the email address"""
+        return public_user_to_dict(self)
+
+# Serializers take ORM objects or plain result rows with the same columns,
+# so list endpoints can select columns and skip building objects. They leave
+# datetimes alone; the JSON encoder writes them as ISO 8601.
+PUBLIC_USER_COLUMNS = (User.id, User.username, User.avatar, User.status, User.last_seen)
+
+def public_user_to_dict(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar': user.avatar,
+        'status': user.status,
+        'is_online': presence.is_online(user.id),
+        'last_seen': user.last_seen
+    }
+
+def load_public_users(user_ids):
+    """Side-load ``{id: public dict}`` for ``user_ids`` in one query"""
+    # Group messages have no recipient
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return {}
+    rows = db.session.query(*PUBLIC_USER_COLUMNS).filter(User.id.in_(user_ids))
+    return {row.id: public_user_to_dict(row) for row in rows}
+
+class UserSnapshot(UserMixin):
+    """Read-only copy of a User that outlives its session
+
+    This is what ``current_user`` is. Load the real User to change anything.
+    """
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.avatar = user.avatar
+        self.status = user.status
+        self.last_seen = user.last_seen
+        self.created_at = user.created_at
+    
+    to_dict = User.to_dict
+    to_public_dict = User.to_public_dict
+
+def load_directory():
+    """Directory entries straight from columns, without hydrating User objects"""
+    rows = db.session.query(*PUBLIC_USER_COLUMNS)
+    return [{
+        'id': row.id,
+        'username': row.username,
+        'avatar': row.avatar,
+        'status': row.status,
+        'last_seen': row.last_seen
+    } for row in rows]
+
+directory = DirectoryCache(load_directory)
+
+@event.listens_for(db.session, 'after_flush')
+def _note_user_changes(session, flush_context):
+    changed = session.info.setdefault('changed_user_ids', set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_user_caches(session):
+    changed = session.info.pop('changed_user_ids', None)
+    if changed:
+        directory.invalidate()
+        for user_id in changed:
+            user_cache.invalidate(user_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_user_changes(session):
+    session.info.pop('changed_user_ids', None)
+
+# Read replicas: users who wrote within REPLICA_STICKY_SECONDS read from the
+# primary, so replication lag never hides their own changes. Kept per
+# process; the load balancer's session affinity sends a user's socket and
+# requests to the same worker.
+recent_writers = TTLCache()
+
+def stick_to_primary(user_ids):
+    for user_id in user_ids:
+        recent_writers.set(user_id, True)
+
+@event.listens_for(db.session, 'after_commit')
+def _stick_writer_to_primary(db_session):
+    if has_request_context() and session.get('_user_id'):
+        stick_to_primary([int(session['_user_id'])])
+
+def replica_reads(view):
+    """Run ``view``'s queries on a read replica, unless its user wrote recently"""
+    @functools.wraps(view)
+    def routed(*args, **kwargs):
+        replicas = current_app.extensions.get('read_replicas')
+        if replicas:
+            user_id = session.get('_user_id')
+            if user_id and recent_writers.get(int(user_id)):
+                replica_routing.inc(target='primary')
+            else:
+                g.read_replica = random.choice(replicas)
+                replica_routing.inc(target='replica')
+        return view(*args, **kwargs)
+    return routed
+
+@contextlib.contextmanager
+def on_primary():
+    """Run the block's queries on the primary, even inside :func:`replica_reads`
+
+    For loaders that fill a cross-request cache: a copy read from a lagging
+    replica would be served until it expires.
+    """
+    replica = g.pop('read_replica', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.read_replica = replica
+
+SNIPPET_LENGTH = 100
+
+def conversation_key(user_id, other_id):
+    """Order a pair of user ids so both directions map to the same conversation"""
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
 
 class Message(db.Model):
+    __table_args__ = (
+        # Conversation history, paged by id
+        db.Index('ix_message_conversation', 'low_user_id', 'high_user_id', 'id'),
+        # Marking a peer's unread messages as read
+        db.Index('ix_message_unread', 'recipient_id', 'sender_id', 'is_read'),
+        # Per-user inbox, newest first
+        db.Index('ix_message_recipient_inbox', 'recipient_id', 'id'),
+        db.Index('ix_message_sender_inbox', 'sender_id', 'id'),
+        # Group history and unread counts above a member's watermark
+        db.Index('ix_message_group', 'conversation_id', 'id'),
+        # Who may download an attachment
+        db.Index('ix_message_attachment', 'attachment_id'),
+        # A message resent under the same client_id is saved once
+        db.Index('ix_message_client', 'sender_id', 'client_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Direct messages have a recipient; group messages are stored once,
+    # with the group's conversation_id instead
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
+    # Normalized conversation key, see conversation_key()
+    low_user_id = db.Column(db.Integer)
+    high_user_id = db.Column(db.Integer)
     content = db.Column(db.Text, nullable=False)
+    attachment_id = db.Column(db.Integer, db.ForeignKey('attachment.id'))
+    # Chosen by the sending client; not kept in the archive
+    client_id = db.Column(db.String(64))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False)
     
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.low_user_id is None and self.sender_id is not None and self.recipient_id is not None:
+            self.low_user_id, self.high_user_id = conversation_key(self.sender_id, self.recipient_id)
+    
+    @classmethod
+    def between(cls, user_id, other_id):
+        """Query both directions of the conversation between two users"""
+        low_user_id, high_user_id = conversation_key(user_id, other_id)
+        return cls.query.filter(cls.low_user_id == low_user_id, cls.high_user_id == high_user_id)
+    
+    @classmethod
+    def unread_from(cls, sender_id, recipient_id):
+        """Query the messages ``recipient_id`` has not read yet from ``sender_id``"""
+        return cls.query.filter(
+            cls.recipient_id == recipient_id,
+            cls.sender_id == sender_id,
+            cls.is_read == False
+        )
+    
+    def to_dict(self):
+        return message_to_dict(self)
+
+# Full-text search over Message.content: an FTS5 table kept in sync by
+# triggers on SQLite, an expression GIN index on Postgres
+SEARCH_CONFIG = 'english'
+SEARCH_DDL = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+        "content, content='message', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+        "INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+        "INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN "
+        "INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content); END",
+    ],
+    'postgresql': [
+        "CREATE INDEX IF NOT EXISTS ix_message_content_search ON message "
+        f"USING gin (to_tsvector('{SEARCH_CONFIG}', content))",
+    ],
+}
+# Private-use characters mark matches in snippets until they are escaped
+HIGHLIGHT_START, HIGHLIGHT_STOP = '\ue000', '\ue001'
+
+def create_search_index(connection):
+    for statement in SEARCH_DDL.get(connection.dialect.name, []):
+        connection.execute(text(statement))
+
+@event.listens_for(Message.__table__, 'after_create')
+def _create_search_index(target, connection, **kw):
+    create_search_index(connection)
+
+@event.listens_for(Message.__table__, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    # The triggers go with the message table, the FTS5 table does not
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS message_fts'))
+
+def search_messages(user_id, query, offset=0, limit=20, peer_id=None):
+    """Return up to ``limit + 1`` rows of ``user_id``'s messages matching ``query``
+
+    Rows carry the message columns plus ``snippet``, best match first. Every
+    word must match and the last one may be a prefix, as the user is
+    usually still typing it. Returns ``[]`` if ``query`` has no words.
+    """
+    terms = re.findall(r'\w+', query.lower())[:10]
+    if not terms:
+        return []
+    
+    if peer_id is not None:
+        low_user_id, high_user_id = conversation_key(user_id, peer_id)
+        scope = (Message.low_user_id == low_user_id) & (Message.high_user_id == high_user_id)
+    else:
+        scope = (Message.sender_id == user_id) | (Message.recipient_id == user_id)
+        groups = load_user_groups(user_id)
+        if groups:
+            scope = scope | Message.conversation_id.in_(groups)
+    
+    if db.engine.dialect.name == 'sqlite':
+        fts = table('message_fts', column('rowid'))
+        match = ' '.join(f'"{term}"' for term in terms) + '*'
+        statement = db.select(
+            *MESSAGE_COLUMNS,
+            db.func.snippet(db.literal_column('message_fts'), 0, HIGHLIGHT_START, HIGHLIGHT_STOP, '…', 16).label('snippet')
+        ).select_from(fts).join(Message, Message.id == fts.c.rowid).where(
+            db.literal_column('message_fts').op('MATCH')(match), scope
+        ).order_by(db.func.bm25(db.literal_column('message_fts')), Message.id.desc())
+    else:
+        config = db.literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+        vector = db.func.to_tsvector(config, Message.content)
+        tsquery = db.func.to_tsquery(config, ' & '.join(terms) + ':*')
+        statement = db.select(
+            *MESSAGE_COLUMNS,
+            db.func.ts_headline(
+                config, Message.content, tsquery,
+                f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords=20, MinWords=8'
+            ).label('snippet')
+        ).where(vector.op('@@')(tsquery), scope).order_by(
+            db.func.ts_rank(vector, tsquery).desc(), Message.id.desc()
+        )
+    return db.session.execute(statement.offset(offset).limit(limit + 1)).all()
+
+def highlight(snippet):
+    """HTML-escape a search snippet and turn its match markers into <mark> tags"""
+    return str(escape(snippet)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+MESSAGE_COLUMNS = (
+    Message.id, Message.sender_id, Message.recipient_id, Message.conversation_id, Message.content,
+    Message.attachment_id, Message.timestamp, Message.is_read
+)
+
+def message_to_dict(message):
+    """Serialize a Message, or any result row with the same columns"""
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'conversation_id': message.conversation_id,
+        'content': message.content,
+        'attachment_id': message.attachment_id,
+        'timestamp': message.timestamp,
+        'is_read': message.is_read
+    }
+
+class MessageArchive(db.Model):
+    """Messages older than the retention window, moved out of the hot table
+
+    Same columns and ids as Message, filled by ``database_setup.py archive``.
+    On Postgres the table is partitioned by month, so old months can be
+    detached or dropped whole.
+    """
+    __tablename__ = 'message_archive'
+    __table_args__ = (
+        db.Index('ix_message_archive_conversation', 'low_user_id', 'high_user_id', 'id'),
+        db.Index('ix_message_archive_group', 'conversation_id', 'id'),
+        db.Index('ix_message_archive_attachment', 'attachment_id'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Part of the key because Postgres partitions on it
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    sender_id = db.Column(db.Integer, nullable=False)
+    recipient_id = db.Column(db.Integer)
+    conversation_id = db.Column(db.Integer)
+    low_user_id = db.Column(db.Integer)
+    high_user_id = db.Column(db.Integer)
+    content = db.Column(db.Text, nullable=False)
+    attachment_id = db.Column(db.Integer)
+    is_read = db.Column(db.Boolean, default=False)
+    
+    @classmethod
+    def between(cls, user_id, other_id):
+        low_user_id, high_user_id = conversation_key(user_id, other_id)
+        return cls.query.filter(cls.low_user_id == low_user_id, cls.high_user_id == high_user_id)
+
+ARCHIVE_COLUMNS = (
+    MessageArchive.id, MessageArchive.sender_id, MessageArchive.recipient_id, MessageArchive.conversation_id,
+    MessageArchive.content, MessageArchive.attachment_id, MessageArchive.timestamp, MessageArchive.is_read
+)
+
+class Attachment(db.Model):
+    """An uploaded file; the bytes are in the attachment store under ``sha256``
+
+    Every upload gets its own row, name and uploader, but identical content
+    is stored once.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    content_type = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    uploader_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
     def to_dict(self):
         return {
             'id': self.id,
-            'sender_id': self.sender_id,
-            'recipient_id': self.recipient_id,
-            'content': self.content,
-            'timestamp': self.timestamp.isoformat(),
-            'is_read': self.is_read,
-            'sender': self.sender.to_dict() if self.sender else None
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'sha256': self.sha256,
+            'url': url_for('main.download_attachment', attachment_id=self.id)
+        }
+
+# Shown in the browser; anything else downloads, so an uploaded page or
+# script never runs on this origin
+INLINE_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'application/pdf'}
+INLINE_CONTENT_PREFIXES = ('audio/', 'video/')
+
+attachment_store = AttachmentStore()
+
+def can_read_attachment(user_id, attachment):
+    """True if ``user_id`` uploaded ``attachment`` or can see a message carrying it"""
+    if attachment.uploader_id == user_id:
+        return True
+    for model in (Message, MessageArchive):
+        scope = (model.sender_id == user_id) | (model.recipient_id == user_id)
+        groups = load_user_groups(user_id)
+        if groups:
+            scope = scope | model.conversation_id.in_(groups)
+        query = db.session.query(model.id).filter(model.attachment_id == attachment.id, scope)
+        if db.session.query(query.exists()).scalar():
+            return True
+    return False
+
+class Conversation(db.Model):
+    """Denormalized summary of a conversation, kept current on every send
+
+    A direct conversation is keyed by its two users; a group has neither
+    key and its members are the ConversationMember rows.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('low_user_id', 'high_user_id', name='uq_conversation_pair'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    low_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    high_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    is_group = db.Column(db.Boolean, default=False)
+    title = db.Column(db.String(100))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_message_id = db.Column(db.Integer)
+    last_message_snippet = db.Column(db.String(SNIPPET_LENGTH))
+    last_message_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    members = db.relationship('ConversationMember', backref='conversation', lazy='dynamic')
+    
+    def to_dict(self):
+        return conversation_to_dict(self)
+
+def conversation_to_dict(conversation):
+    """Serialize a Conversation, or any result row with the same columns"""
+    return {
+        'id': conversation.id,
+        'is_group': bool(conversation.is_group),
+        'title': conversation.title,
+        'last_message': {
+            'id': conversation.last_message_id,
+            'snippet': conversation.last_message_snippet,
+            'timestamp': conversation.last_message_at
+        } if conversation.last_message_id else None
+    }
+
+class ConversationMember(db.Model):
+    """A participant in a conversation and their read state
+
+    Direct conversations keep ``unread_count`` current on every send. Groups
+    don't: their unread count is what lies above ``last_read_message_id``.
+    """
+    __table_args__ = (
+        # Inbox lookup: every conversation a user belongs to
+        db.Index('ix_conversation_member_user', 'user_id', 'conversation_id'),
+    )
+
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    # Highest message id this member has reported as read
+    last_read_message_id = db.Column(db.Integer)
+
+# Group membership, cached per process like current_user. Joins and leaves
+# handled elsewhere arrive through apply_membership_changes(); without a
+# message queue nothing else writes them
+group_members = TTLCache()  # conversation id -> frozenset of member ids
+user_groups = TTLCache()  # user id -> frozenset of group conversation ids
+
+def load_group_members(conversation_id):
+    """Member ids of group ``conversation_id``; empty if it is not a group"""
+    members = group_members.get(conversation_id)
+    if members is None:
+        with on_primary():
+            members = frozenset(row[0] for row in db.session.query(ConversationMember.user_id).join(
+                Conversation, Conversation.id == ConversationMember.conversation_id
+            ).filter(Conversation.id == conversation_id, Conversation.is_group == True))
+        group_members.set(conversation_id, members)
+    return members
+
+def load_user_groups(user_id):
+    """Ids of the groups ``user_id`` belongs to"""
+    groups = user_groups.get(user_id)
+    if groups is None:
+        with on_primary():
+            groups = frozenset(row[0] for row in db.session.query(ConversationMember.conversation_id).join(
+                Conversation, Conversation.id == ConversationMember.conversation_id
+            ).filter(ConversationMember.user_id == user_id, Conversation.is_group == True))
+        user_groups.set(user_id, groups)
+    return groups
+
+def forget_membership(conversation_id, user_ids):
+    group_members.invalidate(conversation_id)
+    for user_id in user_ids:
+        user_groups.invalidate(user_id)
+
+def snippet(content):
+    """Shorten message content for conversation previews"""
+    return content if len(content) <= SNIPPET_LENGTH else content[:SNIPPET_LENGTH - 1] + '…'
+
+def update_conversations(messages):
+    """Fold newly inserted messages into their conversation summaries
+
+    ``messages`` are result rows or Message objects in id order. Runs inside
+    the caller's transaction, and is safe against other workers' writers
+    doing the same for the same conversations at once.
+    """
+    latest = {}
+    unread = {}
+    for message in messages:
+        key = (message.low_user_id, message.high_user_id)
+        latest[key] = message
+        unread[(key, message.recipient_id)] = unread.get((key, message.recipient_id), 0) + 1
+    
+    conversation_ids = load_conversation_ids(list(latest))
+    missing = [key for key in latest if key not in conversation_ids]
+    created = []
+    if missing:
+        # Another writer may create the same pair at the same time; the
+        # first row wins and the other insert does nothing
+        created = db.session.execute(
+            insert_ignoring_conflicts(Conversation, 'low_user_id', 'high_user_id')
+            .returning(Conversation.id, Conversation.low_user_id, Conversation.high_user_id),
+            [
+                {
+                    'low_user_id': key[0],
+                    'high_user_id': key[1],
+                    'is_group': False,
+                    'last_message_id': latest[key].id,
+                    'last_message_snippet': snippet(latest[key].content),
+                    'last_message_at': latest[key].timestamp,
+                    'created_at': datetime.utcnow()
+                }
+                for key in missing
+            ]
+        ).all()
+        if created:
+            db.session.execute(insert(ConversationMember), [
+                {'conversation_id': row.id, 'user_id': user_id, 'unread_count': 0}
+                for row in created
+                for user_id in {row.low_user_id, row.high_user_id}
+            ])
+        conversation_ids.update(((row.low_user_id, row.high_user_id), row.id) for row in created)
+        lost = [key for key in missing if key not in conversation_ids]
+        if lost:
+            conversation_ids.update(load_conversation_ids(lost))
+    # Rows created just now already point at their newest message
+    created_ids = {row.id for row in created}
+    advance_conversations({
+        conversation_ids[key]: message for key, message in latest.items()
+        if conversation_ids[key] not in created_ids
+    })
+    
+    members = ConversationMember.__table__
+    db.session.execute(
+        members.update()
+        .where(members.c.conversation_id == bindparam('conversation'))
+        .where(members.c.user_id == bindparam('member'))
+        .values(unread_count=members.c.unread_count + bindparam('count')),
+        [
+            {'conversation': conversation_ids[key], 'member': user_id, 'count': count}
+            for (key, user_id), count in unread.items()
+        ]
+    )
+
+def load_conversation_ids(keys):
+    """``{(low_user_id, high_user_id): conversation id}`` for the direct conversations that exist"""
+    rows = db.session.query(Conversation.id, Conversation.low_user_id, Conversation.high_user_id).filter(
+        tuple_(Conversation.low_user_id, Conversation.high_user_id).in_(keys)
+    )
+    return {(row.low_user_id, row.high_user_id): row.id for row in rows}
+
+def advance_conversations(latest):
+    """Point summaries at ``{conversation_id: message}``, unless they show a newer message
+
+    Writers committing out of order can't move a summary back to an older
+    message.
+    """
+    if not latest:
+        return
+    conversations = Conversation.__table__
+    db.session.execute(
+        conversations.update()
+        .where(conversations.c.id == bindparam('conversation'))
+        .where(db.or_(conversations.c.last_message_id.is_(None),
+                      conversations.c.last_message_id < bindparam('message_id')))
+        .values(
+            last_message_id=bindparam('message_id'),
+            last_message_snippet=bindparam('message_snippet'),
+            last_message_at=bindparam('message_at')
+        ),
+        [
+            {
+                'conversation': conversation_id,
+                'message_id': message.id,
+                'message_snippet': snippet(message.content),
+                'message_at': message.timestamp
+            }
+            for conversation_id, message in latest.items()
+        ]
+    )
+
+def update_group_conversations(messages):
+    """Point each group's summary at its newest message in ``messages``
+
+    One row per group, however many members it has; group unread counts
+    come from read watermarks instead. Runs inside the caller's transaction.
+    """
+    advance_conversations({message.conversation_id: message for message in messages})
+
+def count_group_unread(user_id, conversation_ids):
+    """``{conversation_id: messages from others above user_id's watermark}``"""
+    if not conversation_ids:
+        return {}
+    rows = db.session.query(Message.conversation_id, db.func.count(Message.id)).join(
+        ConversationMember,
+        (ConversationMember.conversation_id == Message.conversation_id) & (ConversationMember.user_id == user_id)
+    ).filter(
+        Message.conversation_id.in_(conversation_ids),
+        Message.id > db.func.coalesce(ConversationMember.last_read_message_id, 0),
+        Message.sender_id != user_id
+    ).group_by(Message.conversation_id)
+    return dict(rows.all())
+
+class SyncEvent(db.Model):
+    """Change log for what delta sync cannot derive from message ids
+
+    An event is for one user (``user_id``) or for every member of a group
+    (``conversation_id``), so a group event is written once however big
+    the group is.
+    """
+    __table_args__ = (
+        db.Index('ix_sync_event_user', 'user_id', 'id'),
+        db.Index('ix_sync_event_conversation', 'conversation_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
+    kind = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return dict(self.data, kind=self.kind)
+
+def save_read_watermarks(watermarks):
+    """Apply ``{(reader_id, peer_id): up_to}`` read watermarks in one batch
+
+    Watermarks for users who share no conversation, or that do not move the
+    stored one forward, are dropped; the rest are capped at the latest
+    message. Leaves a read receipt in each peer's sync log and returns the
+    receipts as ``(reader_id, peer_id, up_to)``. Runs inside the caller's
+    transaction.
+    """
+    wanted = {
+        (reader_id,) + conversation_key(reader_id, peer_id): (peer_id, up_to)
+        for (reader_id, peer_id), up_to in watermarks.items()
+    }
+    rows = db.session.query(
+        ConversationMember.user_id, Conversation.low_user_id, Conversation.high_user_id,
+        Conversation.id, Conversation.last_message_id, ConversationMember.last_read_message_id
+    ).join(Conversation, Conversation.id == ConversationMember.conversation_id).filter(
+        tuple_(ConversationMember.user_id, Conversation.low_user_id, Conversation.high_user_id).in_(list(wanted))
+    )
+    
+    receipts = []
+    params = []
+    for reader_id, low_user_id, high_user_id, conversation_id, last_message_id, last_read in rows:
+        peer_id, up_to = wanted[(reader_id, low_user_id, high_user_id)]
+        up_to = min(up_to, last_message_id or 0)
+        if up_to > (last_read or 0):
+            receipts.append((reader_id, peer_id, up_to))
+            params.append({'conversation': conversation_id, 'reader': reader_id, 'peer': peer_id, 'up_to': up_to})
+    if not receipts:
+        return receipts
+    
+    messages = Message.__table__
+    unread = (
+        (messages.c.recipient_id == bindparam('reader'))
+        & (messages.c.sender_id == bindparam('peer'))
+        & (messages.c.is_read == False)
+    )
+    db.session.execute(
+        messages.update().where(unread).where(messages.c.id <= bindparam('up_to')).values(is_read=True),
+        params
+    )
+    # Recount rather than zero: messages past the watermark are still unread
+    members = ConversationMember.__table__
+    db.session.execute(
+        members.update()
+        .where(members.c.conversation_id == bindparam('conversation'))
+        .where(members.c.user_id == bindparam('reader'))
+        .values(
+            last_read_message_id=bindparam('up_to'),
+            unread_count=db.select(db.func.count()).select_from(messages).where(unread).scalar_subquery()
+        ),
+        params
+    )
+    serialize_ids(SYNC_EVENT_ID_LOCK)
+    db.session.execute(insert(SyncEvent), [
+        {'user_id': peer_id, 'kind': 'read', 'data': {'user_id': reader_id, 'up_to': up_to}}
+        for reader_id, peer_id, up_to in receipts
+    ])
+    return receipts
+
+def save_group_watermarks(watermarks):
+    """Apply ``{(reader_id, conversation_id): up_to}`` group read watermarks
+
+    Like :func:`save_read_watermarks`, but only the member's watermark
+    moves; group messages carry no per-recipient read flag. Each group's
+    sync log gets one entry listing that group's receipts. Returns the receipts grouped as ``{conversation_id: [{'user_id',
+    'up_to'}, ...]}``.
+    """
+    rows = db.session.query(
+        ConversationMember.user_id, ConversationMember.conversation_id,
+        ConversationMember.last_read_message_id, Conversation.last_message_id
+    ).join(Conversation, Conversation.id == ConversationMember.conversation_id).filter(
+        tuple_(ConversationMember.user_id, ConversationMember.conversation_id).in_(list(watermarks)),
+        Conversation.is_group == True
+    )
+    receipts = {}
+    params = []
+    for reader_id, conversation_id, last_read, last_message_id in rows:
+        up_to = min(watermarks[(reader_id, conversation_id)], last_message_id or 0)
+        if up_to > (last_read or 0):
+            receipts.setdefault(conversation_id, []).append({'user_id': reader_id, 'up_to': up_to})
+            params.append({'conversation': conversation_id, 'reader': reader_id, 'up_to': up_to})
+    if not receipts:
+        return receipts
+    
+    members = ConversationMember.__table__
+    db.session.execute(
+        members.update()
+        .where(members.c.conversation_id == bindparam('conversation'))
+        .where(members.c.user_id == bindparam('reader'))
+        .values(last_read_message_id=bindparam('up_to')),
+        params
+    )
+    serialize_ids(SYNC_EVENT_ID_LOCK)
+    db.session.execute(insert(SyncEvent), [
+        {
+            'conversation_id': conversation_id,
+            'kind': 'read',
+            'data': {'conversation_id': conversation_id, 'receipts': readers}
         }
+        for conversation_id, readers in receipts.items()
+    ])
+    return receipts
+
+# pg_advisory_xact_lock keys, see serialize_ids()
+MESSAGE_ID_LOCK = 0x6d657373
+SYNC_EVENT_ID_LOCK = 0x73796e63
+
+def serialize_ids(lock):
+    """Make ids taken under ``lock`` commit in the order they were handed out
+
+    Sync cursors are ids, but Postgres hands an id out at insert time. Two
+    workers' writers could commit out of order, and a client that synced
+    past the higher id would never see the lower one. Holding a transaction
+    lock from the insert to the commit rules that out; writers already
+    batch, so they take it once per batch. SQLite allows one writer at a
+    time anyway.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': lock})
+
+def encode_sync_cursor(message_id, event_id):
+    return f'{message_id}.{event_id}'
+
+def decode_sync_cursor(cursor):
+    """Split a sync cursor into ``(message_id, event_id)``; ValueError if malformed"""
+    message_id, event_id = cursor.split('.')
+    return int(message_id), int(event_id)
 
 # Forms
 class LoginForm(FlaskForm):
@@ -103,36 +1049,199 @@ class MessageForm(FlaskForm):
     content = TextAreaField('Message', validators=[DataRequired()])
     submit = SubmitField('Send')
 
+# Message pipeline
+def parse_new_message(data):
+    """Validate a send request; returns ``(fields, error)``
+
+    ``fields`` are the keyword arguments for :meth:`MessageWriter.submit`.
+    Direct messages name a ``recipient_id``, group messages a
+    ``conversation_id``; with an ``attachment_id`` the content may be empty.
+    Sending again with the same ``client_id`` returns the saved message.
+    """
+    if not isinstance(data, dict):
+        return None, 'Message must be a JSON object'
+    
+    def optional_id(name):
+        try:
+            return int(data.get(name))
+        except (TypeError, ValueError):
+            return None
+    
+    content = data.get('content') or ''
+    recipient_id = optional_id('recipient_id')
+    conversation_id = optional_id('conversation_id')
+    attachment_id = optional_id('attachment_id')
+    if conversation_id:
+        recipient_id = None
+    if not (recipient_id or conversation_id) or not (content or attachment_id) or not isinstance(content, str):
+        return None, 'Missing recipient or content'
+    client_id = data.get('client_id')
+    if client_id is not None and not (isinstance(client_id, str) and 0 < len(client_id) <= 64):
+        return None, 'client_id must be a string of at most 64 characters'
+    return {
+        'recipient_id': recipient_id,
+        'conversation_id': conversation_id,
+        'content': content,
+        'attachment_id': attachment_id,
+        'client_id': client_id
+    }, None
+
+def insert_ignoring_conflicts(model, *key):
+    """INSERT for ``model`` that skips rows clashing on the unique ``key`` columns"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model).on_conflict_do_nothing(index_elements=list(key))
+
+def persist_messages(app, batch):
+    """Store a batch of queued messages with one multi-row insert and one commit"""
+    with app.app_context():
+        recipient_ids = {pending.recipient_id for pending in batch if pending.recipient_id}
+        known_ids = set()
+        if recipient_ids:
+            known_ids = {row[0] for row in db.session.query(User.id).filter(User.id.in_(recipient_ids))}
+        attachment_ids = {pending.attachment_id for pending in batch if pending.attachment_id}
+        uploaders = {}
+        if attachment_ids:
+            uploaders = dict(db.session.query(Attachment.id, Attachment.uploader_id).filter(
+                Attachment.id.in_(attachment_ids)
+            ))
+        
+        timestamp = datetime.utcnow()
+        saved = []
+        for pending in batch:
+            # Only the uploader can attach a file; anyone it is sent to can download it
+            if pending.attachment_id and uploaders.get(pending.attachment_id) != pending.sender_id:
+                pending.error = ('Attachment not found', 404)
+                continue
+            if pending.conversation_id:
+                if pending.sender_id not in load_group_members(pending.conversation_id):
+                    pending.error = ('Conversation not found', 404)
+                    continue
+                low_user_id = high_user_id = None
+            elif pending.recipient_id not in known_ids:
+                pending.error = ('Recipient not found', 404)
+                continue
+            else:
+                low_user_id, high_user_id = conversation_key(pending.sender_id, pending.recipient_id)
+            saved.append(pending)
+            pending.payload = {
+                'sender_id': pending.sender_id,
+                'recipient_id': pending.recipient_id,
+                'conversation_id': pending.conversation_id,
+                'low_user_id': low_user_id,
+                'high_user_id': high_user_id,
+                'content': pending.content,
+                'attachment_id': pending.attachment_id,
+                'client_id': pending.client_id,
+                'timestamp': timestamp,
+                'is_read': False
+            }
+        
+        if saved:
+            # RETURNING order is not guaranteed for a multi-row insert, so
+            # match rows back to their senders by value; identical messages
+            # in one batch are interchangeable
+            waiting = {}
+            for pending in saved:
+                key = (pending.sender_id, pending.recipient_id, pending.conversation_id, pending.content,
+                       pending.attachment_id, pending.client_id)
+                waiting.setdefault(key, []).append(pending)
+            serialize_ids(MESSAGE_ID_LOCK)
+            rows = db.session.execute(
+                insert_ignoring_conflicts(Message, 'sender_id', 'client_id').returning(*Message.__table__.columns),
+                [pending.payload for pending in saved]
+            ).all()
+            for row in rows:
+                pending = waiting[
+                    (row.sender_id, row.recipient_id, row.conversation_id, row.content, row.attachment_id,
+                     row.client_id)
+                ].pop()
+                pending.payload = message_to_dict(row)
+            # Whatever is left was a resend of a saved message: answer with
+            # that one, without delivering it again
+            resent = [pending for left in waiting.values() for pending in left]
+            if resent:
+                existing = {
+                    (row.sender_id, row.client_id): row
+                    for row in db.session.query(*MESSAGE_COLUMNS, Message.client_id).filter(
+                        tuple_(Message.sender_id, Message.client_id).in_(
+                            {(pending.sender_id, pending.client_id) for pending in resent}
+                        )
+                    )
+                }
+                for pending in resent:
+                    row = existing.get((pending.sender_id, pending.client_id))
+                    if row is None:
+                        pending.error = ('Could not save message', 500)
+                        continue
+                    pending.payload = message_to_dict(row)
+                    pending.duplicate = True
+            rows.sort(key=lambda row: row.id)
+            direct = [row for row in rows if row.conversation_id is None]
+            grouped = [row for row in rows if row.conversation_id is not None]
+            if direct:
+                update_conversations(direct)
+            if grouped:
+                update_group_conversations(grouped)
+        db.session.commit()
+        stick_to_primary({pending.sender_id for pending in saved})
+
+def deliver_message(pending):
+    """Fan a committed message out to its recipient, or to its group's room"""
+    if pending.error or pending.duplicate:
+        return
+    if pending.conversation_id:
+        # One emit to the room; the message queue and each server do the
+        # per-member work instead of this loop
+        socketio.emit('new_message', {
+            'message': pending.payload
+        }, room=f'conversation_{pending.conversation_id}')
+        emit_fanout.observe(1, event='new_message')
+        return
+    presence.add_contact(pending.sender_id, pending.recipient_id)
+    typing_tracker.stop(pending.sender_id, pending.recipient_id)
+    socketio.emit('new_message', {
+        'message': pending.payload
+    }, room=f'user_{pending.recipient_id}')
+    emit_fanout.observe(1, event='new_message')
+
+message_writer = MessageWriter()
+
 # Routes
-@app.route('/')
+@main.route('/')
 def index():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
-    return redirect(url_for('login'))
+        return redirect(url_for('main.chat'))
+    return redirect(url_for('main.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
+        # Don't hold a pooled connection while the password is hashed
+        db.session.close()
         if user and user.check_password(form.password.data):
+            db.session.add(user)
             login_user(user)
             user.is_online = True
             user.last_seen = datetime.utcnow()
             db.session.commit()
             flash('Welcome back!', 'success')
-            return redirect(url_for('chat'))
+            return redirect(url_for('main.chat'))
         flash('Invalid email or password', 'error')
     
     return render_template('auth.html', form=form, is_login=True)
 
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     
     form = RegisterForm()
     if form.validate_on_submit():
@@ -158,149 +1267,953 @@ def register():
         db.session.commit()
         
         flash('Account created successfully!', 'success')
-        return redirect(url_for('chat'))
+        return redirect(url_for('main.chat'))
     
     return render_template('auth.html', form=form, is_login=False)
 
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
-    current_user.is_online = False
-    current_user.last_seen = datetime.utcnow()
+    user = db.session.get(User, current_user.id)
+    user.is_online = False
+    user.last_seen = datetime.utcnow()
     db.session.commit()
+    user_cache.invalidate(user.id)
     logout_user()
     flash('You have been logged out', 'info')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/chat')
+@main.route('/chat')
 @login_required
 def chat():
-    users = User.query.filter(User.id != current_user.id).all()
-    return render_template('chat.html', users=users)
+    return render_template('chat.html')
 
-@app.route('/api/users')
+@main.route('/api/users')
 @login_required
 def get_users():
-    users = User.query.filter(User.id != current_user.id).all()
-    return jsonify([user.to_dict() for user in users])
+    """Page through the user directory, optionally by username prefix ``q``
+
+    Served from the directory cache. The ETag is a hash of the page itself,
+    so it means the same on every worker and across restarts, and an
+    unchanged page costs the client a 304.
+    """
+    prefix = request.args.get('q', '').strip().lower()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', current_app.config['DIRECTORY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['DIRECTORY_MAX_PAGE_SIZE']))
+    
+    entries, has_more = directory.page(prefix, offset, limit, exclude_id=current_user.id)
+    body = serializer.dumps_bytes({
+        'users': [dict(entry, is_online=presence.is_online(entry['id'])) for entry in entries],
+        'has_more': has_more
+    })
+    etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@main.route('/api/conversations')
+@login_required
+@replica_reads
+def get_conversations():
+    """Return the current user's inbox, most recent conversation first"""
+    limit = request.args.get('limit', current_app.config['MESSAGES_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['MESSAGES_MAX_PAGE_SIZE']))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    rows = db.session.query(
+        Conversation.id, Conversation.low_user_id, Conversation.high_user_id, Conversation.is_group,
+        Conversation.title, Conversation.last_message_id, Conversation.last_message_snippet,
+        Conversation.last_message_at, ConversationMember.unread_count
+    ).join(
+        ConversationMember, ConversationMember.conversation_id == Conversation.id
+    ).filter(
+        ConversationMember.user_id == current_user.id
+    ).order_by(
+        db.func.coalesce(Conversation.last_message_at, Conversation.created_at).desc()
+    ).offset(offset).limit(limit).all()
+    
+    def peer_id(conversation):
+        if conversation.is_group:
+            return None
+        if conversation.low_user_id == current_user.id:
+            return conversation.high_user_id
+        return conversation.low_user_id
+    
+    group_unread = count_group_unread(current_user.id, [row.id for row in rows if row.is_group])
+    inbox = []
+    for row in rows:
+        entry = conversation_to_dict(row)
+        entry['user_id'] = peer_id(row)
+        entry['unread_count'] = group_unread.get(row.id, 0) if row.is_group else row.unread_count
+        inbox.append(entry)
+    return jsonify({
+        'conversations': inbox,
+        'users': load_public_users({entry['user_id'] for entry in inbox})
+    })
+
+@main.route('/api/stats')
+@login_required
+def stats():
+    return jsonify({
+        'user_cache': user_cache.stats(),
+        'directory': {'hits': directory.hits, 'misses': directory.misses, 'version': directory.version},
+        'typing': typing_tracker.stats(),
+        'read_receipts': read_receipts.stats()
+    })
+
+@main.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint; needs ``Bearer <METRICS_TOKEN>`` if that is set"""
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    response = make_response(metrics.render())
+    response.mimetype = 'text/plain; version=0.0.4'
+    return response
 
-@app.route('/api/messages/<int:user_id>')
+@main.route('/api/messages/<int:user_id>')
 @login_required
+@replica_reads
 def get_messages(user_id):
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.recipient_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.recipient_id == current_user.id))
-    ).order_by(Message.timestamp.asc()).all()
-    
-    # Mark messages as read
-    Message.query.filter(
-        (Message.sender_id == user_id) & 
-        (Message.recipient_id == current_user.id) & 
-        (Message.is_read == False)
-    ).update({'is_read': True})
+    """Return one page of the conversation with ``user_id``.
+
+    Pages are keyed on ``Message.id``: without a cursor the newest page is
+    returned, ``before_id`` walks back through older history and ``after_id``
+    fetches anything newer than the last message the client has seen.
+    Fetching never marks anything read; see :func:`mark_read`.
+    """
+    return history_page(
+        Message.between(current_user.id, user_id),
+        MessageArchive.between(current_user.id, user_id)
+    )
+
+def history_page(query, archived):
+    """Page through ``query``'s messages, running on into ``archived``
+
+    Reads ``before_id``, ``after_id`` and ``limit`` from the request, as
+    described on :func:`get_messages`.
+    """
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', current_app.config['MESSAGES_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['MESSAGES_MAX_PAGE_SIZE']))
+
+    if before_id is not None and after_id is not None:
+        return jsonify({'error': 'Use either before_id or after_id, not both'}), 400
+
+    query = query.with_entities(*MESSAGE_COLUMNS)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id).order_by(Message.id.asc())
+    else:
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        query = query.order_by(Message.id.desc())
+
+    # Fetch one extra row to learn whether another page exists
+    messages = query.limit(limit + 1).all()
+    # Archived messages all have lower ids than the hot ones, so history
+    # runs on into the archive where the hot table ends
+    archived = archived.with_entities(*ARCHIVE_COLUMNS)
+    if after_id is not None:
+        older = archived.filter(MessageArchive.id > after_id).order_by(MessageArchive.id.asc())
+        messages = older.limit(limit + 1).all() + messages
+    elif len(messages) <= limit:
+        oldest = messages[-1].id if messages else before_id
+        if oldest is not None:
+            archived = archived.filter(MessageArchive.id < oldest)
+        older = archived.order_by(MessageArchive.id.desc()).limit(limit + 1 - len(messages))
+        messages += older.all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after_id is None:
+        messages.reverse()
+
+    next_cursor = None
+    if has_more:
+        next_cursor = messages[-1].id if after_id is not None else messages[0].id
+    
+    # Side-load each participant and attachment once instead of embedding it per message
+    user_ids = {msg.sender_id for msg in messages} | {msg.recipient_id for msg in messages}
+    attachment_ids = {msg.attachment_id for msg in messages if msg.attachment_id}
+    attachments = Attachment.query.filter(Attachment.id.in_(attachment_ids)) if attachment_ids else []
+    
+    return jsonify({
+        'messages': [message_to_dict(msg) for msg in messages],
+        'users': load_public_users(user_ids),
+        'attachments': {attachment.id: attachment.to_dict() for attachment in attachments},
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    })
+
+EXPORT_FIELDS = tuple(column.key for column in MESSAGE_COLUMNS)
+
+def export_batches(query, archived):
+    """Yield all of ``query``'s messages, oldest first, in batches of rows
+
+    Archived messages come first, since their ids are all lower. Each table
+    is read through one server-side cursor along the history index, so rows
+    are fetched ``EXPORT_BATCH_SIZE`` at a time rather than all at once.
+    Messages the archive command moves while an export runs can be missed.
+    """
+    options = {'yield_per': current_app.config['EXPORT_BATCH_SIZE']}
+    for statement in (
+        archived.with_entities(*ARCHIVE_COLUMNS).order_by(MessageArchive.id.asc()).statement,
+        query.with_entities(*MESSAGE_COLUMNS).order_by(Message.id.asc()).statement,
+    ):
+        with db.session.execute(statement, execution_options=options) as result:
+            yield from result.partitions()
+
+@main.route('/api/export/<int:user_id>')
+@login_required
+@replica_reads
+def export_messages(user_id):
+    """Download the whole conversation with ``user_id`` as NDJSON or CSV
+
+    ``format`` is ``ndjson`` (the default) or ``csv``; either way there is
+    one message per line with the fields of :func:`message_to_dict`, oldest
+    first. The body is streamed while it is read from the database.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    batches = export_batches(Message.between(current_user.id, user_id), MessageArchive.between(current_user.id, user_id))
+    return current_app.response_class(
+        stream_with_context(encode_export(batches, EXPORT_FIELDS, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename=conversation-{current_user.id}-{user_id}.{fmt}'}
+    )
+
+@main.route('/api/messages/<int:user_id>/read', methods=['POST'])
+@login_required
+def mark_read(user_id):
+    """Report that ``user_id``'s messages up to ``up_to`` have been read
+
+    The watermark is saved and sent on as a read receipt shortly after.
+    """
+    up_to = (request.get_json(silent=True) or {}).get('up_to')
+    if not isinstance(up_to, int) or isinstance(up_to, bool) or up_to < 1:
+        return jsonify({'error': 'up_to must be a message id'}), 400
+    queue_read_receipt(current_user.id, user_id, up_to)
+    return jsonify({'status': 'queued'}), 202
+
+def parse_member_ids(data):
+    """``member_ids`` from a request body as a set of ints, or None if malformed"""
+    member_ids = data.get('member_ids')
+    if not isinstance(member_ids, list):
+        return None
+    if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in member_ids):
+        return None
+    return set(member_ids)
+
+def move_into_room(user_ids, conversation_id, join=True):
+    """Add or remove the sockets of ``user_ids`` on this worker to a group's room
+
+    Other workers move their own sockets in :func:`apply_membership_changes`.
+    """
+    room = f'conversation_{conversation_id}'
+    sockets = socketio.server.manager.get_participants('/', [f'user_{user_id}' for user_id in user_ids])
+    for sid, _ in list(sockets):
+        if join:
+            socketio.server.enter_room(sid, room)
+        else:
+            socketio.server.leave_room(sid, room)
+
+def add_group_members(conversation, user_ids):
+    """Add the existing users among ``user_ids`` to ``conversation``; returns their ids
+
+    Logs a ``joined`` event for :func:`apply_membership_changes`.
+    """
+    user_ids = {row[0] for row in db.session.query(User.id).filter(User.id.in_(user_ids))}
+    user_ids -= {row[0] for row in db.session.query(ConversationMember.user_id).filter(
+        ConversationMember.conversation_id == conversation.id, ConversationMember.user_id.in_(user_ids)
+    )}
+    if user_ids:
+        # New members start with everything so far read
+        db.session.execute(insert(ConversationMember), [
+            {
+                'conversation_id': conversation.id,
+                'user_id': user_id,
+                'unread_count': 0,
+                'last_read_message_id': conversation.last_message_id
+            }
+            for user_id in user_ids
+        ])
+        serialize_ids(SYNC_EVENT_ID_LOCK)
+        db.session.add(SyncEvent(
+            conversation_id=conversation.id, kind='joined', data={'user_ids': sorted(user_ids)}
+        ))
+    return user_ids
+
+def announce_group(conversation, user_ids):
+    """Tell ``user_ids`` they are now in ``conversation`` and subscribe their sockets"""
+    move_into_room(user_ids, conversation.id)
+    socketio.emit('group_added', {
+        'conversation': conversation_to_dict(conversation)
+    }, to=[f'user_{user_id}' for user_id in user_ids])
+    emit_fanout.observe(len(user_ids), event='group_added')
+
+@main.route('/api/conversations', methods=['POST'])
+@login_required
+def create_group():
+    """Start a group conversation with ``member_ids`` and an optional ``title``"""
+    data = request.get_json(silent=True) or {}
+    member_ids = parse_member_ids(data)
+    title = data.get('title')
+    if member_ids is None:
+        return jsonify({'error': 'member_ids must be a list of user ids'}), 400
+    if title is not None and (not isinstance(title, str) or len(title) > 100):
+        return jsonify({'error': 'title must be at most 100 characters'}), 400
+    member_ids.add(current_user.id)
+    if len(member_ids) > current_app.config['GROUP_MAX_MEMBERS']:
+        return jsonify({'error': 'Too many members'}), 400
+    
+    conversation = Conversation(is_group=True, title=title or None, created_by=current_user.id)
+    db.session.add(conversation)
+    db.session.flush()
+    member_ids = add_group_members(conversation, member_ids)
     db.session.commit()
+    forget_membership(conversation.id, member_ids)
+    announce_group(conversation, member_ids)
+    return jsonify(dict(conversation_to_dict(conversation), member_ids=sorted(member_ids))), 201
+
+@main.route('/api/conversations/<int:conversation_id>/members', methods=['POST'])
+@login_required
+def add_members(conversation_id):
+    """Add ``member_ids`` to a group the current user is in"""
+    if current_user.id not in load_group_members(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    member_ids = parse_member_ids(request.get_json(silent=True) or {})
+    if member_ids is None:
+        return jsonify({'error': 'member_ids must be a list of user ids'}), 400
+    if len(member_ids) > current_app.config['GROUP_MAX_MEMBERS']:
+        return jsonify({'error': 'Too many members'}), 400
     
-    return jsonify([msg.to_dict() for msg in messages])
+    conversation = db.session.get(Conversation, conversation_id)
+    count = conversation.members.count()
+    added = add_group_members(conversation, member_ids)
+    if count + len(added) > current_app.config['GROUP_MAX_MEMBERS']:
+        db.session.rollback()
+        return jsonify({'error': 'Too many members'}), 400
+    db.session.commit()
+    forget_membership(conversation_id, added)
+    if added:
+        announce_group(conversation, added)
+    return jsonify({'added': sorted(added)})
+
+@main.route('/api/conversations/<int:conversation_id>/leave', methods=['POST'])
+@login_required
+def leave_group(conversation_id):
+    """Leave a group; logs a ``left`` event for :func:`apply_membership_changes`"""
+    if current_user.id not in load_group_members(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    ConversationMember.query.filter_by(conversation_id=conversation_id, user_id=current_user.id).delete()
+    serialize_ids(SYNC_EVENT_ID_LOCK)
+    db.session.add(SyncEvent(conversation_id=conversation_id, kind='left', data={'user_ids': [current_user.id]}))
+    db.session.commit()
+    forget_membership(conversation_id, [current_user.id])
+    move_into_room([current_user.id], conversation_id, join=False)
+    socketio.emit('group_removed', {'conversation_id': conversation_id}, to=f'user_{current_user.id}')
+    return '', 204
+
+def apply_membership_changes(after):
+    """Catch this worker up on group joins and leaves logged since event ``after``
+
+    Forgets the cached membership and moves the sockets on this worker into
+    or out of the group rooms. Pass None on the first call to start from
+    now. Returns the event id to pass next time.
+    """
+    if after is None:
+        return db.session.query(db.func.max(SyncEvent.id)).scalar() or 0
+    changes = db.session.query(SyncEvent.id, SyncEvent.conversation_id, SyncEvent.kind, SyncEvent.data).filter(
+        SyncEvent.id > after, SyncEvent.kind.in_(('joined', 'left'))
+    ).order_by(SyncEvent.id.asc()).all()
+    for event_id, conversation_id, kind, data in changes:
+        forget_membership(conversation_id, data['user_ids'])
+        move_into_room(data['user_ids'], conversation_id, join=kind == 'joined')
+        after = event_id
+    return after
+
+def membership_worker(app):
+    """Apply group membership changes made through other workers"""
+    with app.app_context():
+        after = apply_membership_changes(None)
+    while True:
+        socketio.sleep(app.config['MEMBERSHIP_SYNC_INTERVAL'])
+        with app.app_context():
+            try:
+                after = apply_membership_changes(after)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Applying membership changes failed')
 
-@app.route('/api/send_message', methods=['POST'])
+@main.route('/api/conversations/<int:conversation_id>/messages')
+@login_required
+@replica_reads
+def get_group_messages(conversation_id):
+    """Return one page of a group's history; paged like :func:`get_messages`"""
+    if current_user.id not in load_group_members(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    return history_page(
+        Message.query.filter(Message.conversation_id == conversation_id),
+        MessageArchive.query.filter(MessageArchive.conversation_id == conversation_id)
+    )
+
+@main.route('/api/conversations/<int:conversation_id>/read', methods=['POST'])
+@login_required
+def mark_group_read(conversation_id):
+    """Move the current user's read watermark in a group up to ``up_to``"""
+    up_to = (request.get_json(silent=True) or {}).get('up_to')
+    if not isinstance(up_to, int) or isinstance(up_to, bool) or up_to < 1:
+        return jsonify({'error': 'up_to must be a message id'}), 400
+    if current_user.id not in load_group_members(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    queue_group_read_receipt(current_user.id, conversation_id, up_to)
+    return jsonify({'status': 'queued'}), 202
+
+@main.route('/api/sync')
+@login_required
+def sync():
+    """Return what changed for the current user since ``since``
+
+    The cursor is opaque to clients: keep the returned ``cursor`` and send
+    it back next time. Without ``since`` only a cursor for "now" is
+    returned. While ``has_more`` is true, call again straight away.
+    """
+    limit = request.args.get('limit', current_app.config['MESSAGES_MAX_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['MESSAGES_MAX_PAGE_SIZE']))
+    since = request.args.get('since')
+    if not since:
+        message_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+        event_id = db.session.query(db.func.max(SyncEvent.id)).scalar() or 0
+        return jsonify({'cursor': encode_sync_cursor(message_id, event_id), 'has_more': False})
+    try:
+        message_id, event_id = decode_sync_cursor(since)
+    except ValueError:
+        return jsonify({'error': 'Invalid sync cursor'}), 400
+    
+    # Each side of the union walks its own inbox index; messages to
+    # yourself come from the sent side only
+    received = db.session.query(*MESSAGE_COLUMNS).filter(
+        Message.recipient_id == current_user.id, Message.sender_id != current_user.id, Message.id > message_id
+    )
+    sent = db.session.query(*MESSAGE_COLUMNS).filter(Message.sender_id == current_user.id, Message.id > message_id)
+    messages = received.union_all(sent)
+    groups = load_user_groups(current_user.id)
+    if groups:
+        messages = messages.union_all(db.session.query(*MESSAGE_COLUMNS).filter(
+            Message.conversation_id.in_(groups), Message.sender_id != current_user.id, Message.id > message_id
+        ))
+    messages = messages.order_by(Message.id.asc()).limit(limit + 1).all()
+    # Group events are logged once per group, not once per member
+    owners = SyncEvent.user_id == current_user.id
+    if groups:
+        owners = db.or_(owners, SyncEvent.conversation_id.in_(groups))
+    events = SyncEvent.query.filter(owners, SyncEvent.id > event_id).order_by(SyncEvent.id.asc()).limit(limit + 1).all()
+    
+    has_more = len(messages) > limit or len(events) > limit
+    messages, events = messages[:limit], events[:limit]
+    if messages:
+        message_id = messages[-1].id
+    if events:
+        event_id = events[-1].id
+    
+    peer_ids = {msg.sender_id for msg in messages} | {msg.recipient_id for msg in messages}
+    peer_ids.discard(current_user.id)
+    contact_ids = presence.contacts(current_user.id, load_contact_ids) | peer_ids
+    
+    return jsonify({
+        'messages': [message_to_dict(msg) for msg in messages],
+        'read_receipts': [event.to_dict() for event in events if event.kind == 'read'],
+        'users': load_public_users(peer_ids),
+        'online': sorted(user_id for user_id in contact_ids if presence.is_online(user_id)),
+        'cursor': encode_sync_cursor(message_id, event_id),
+        'has_more': has_more
+    })
+
+@main.route('/api/search')
+@login_required
+@replica_reads
+def search():
+    """Search the current user's messages, best match first
+
+    ``q`` is the search text; ``user_id`` narrows it to one conversation.
+    Snippets are HTML with matches wrapped in ``<mark>``.
+    """
+    query = request.args.get('q', '').strip()
+    peer_id = request.args.get('user_id', type=int)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', current_app.config['SEARCH_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['SEARCH_MAX_PAGE_SIZE']))
+    
+    rows = search_messages(current_user.id, query, offset, limit, peer_id)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    peer_ids = {row.sender_id for row in rows} | {row.recipient_id for row in rows}
+    peer_ids.discard(current_user.id)
+    return jsonify({
+        'results': [
+            {'message': message_to_dict(row), 'snippet': highlight(row.snippet)}
+            for row in rows
+        ],
+        'users': load_public_users(peer_ids),
+        'has_more': has_more
+    })
+
+@main.route('/api/send_message', methods=['POST'])
 @login_required
 def send_message():
-    data = request.get_json()
-    recipient_id = data.get('recipient_id')
-    content = data.get('content')
+    fields, error = parse_new_message(request.get_json(silent=True))
+    if error:
+        return jsonify({'error': error}), 400
     
-    if not recipient_id or not content:
-        return jsonify({'error': 'Missing recipient or content'}), 400
+    # Hand the connection back to the pool while the writer commits
+    db.session.close()
+    pending = message_writer.send(current_user.id, callback=deliver_message, **fields)
+    if pending.error:
+        message, status = pending.error
+        return jsonify({'error': message}), status
+    return jsonify(pending.payload), 200 if pending.duplicate else 201
+
+@main.route('/api/attachments', methods=['POST'])
+@login_required
+def upload_attachment():
+    """Store the request body as an attachment and return its ``id``
+
+    The body is the file itself, not a form: its type as Content-Type and
+    its name as ``?filename=``. It is streamed to disk as it arrives, so
+    chunked uploads of any size up to ``ATTACHMENT_MAX_SIZE`` cost a worker
+    one chunk of memory. Send the ``id`` as ``attachment_id`` with a message.
+    """
+    if not current_app.config['ENABLE_FILE_UPLOAD']:
+        return jsonify({'error': 'File uploads are disabled'}), 403
+    max_size = current_app.config['ATTACHMENT_MAX_SIZE']
+    too_large = jsonify({'error': f'Attachments are limited to {max_size} bytes'}), 413
+    if request.content_length is not None and request.content_length > max_size:
+        return too_large
     
-    recipient = User.query.get(recipient_id)
-    if not recipient:
-        return jsonify({'error': 'Recipient not found'}), 404
+    # Hand the connection back to the pool while the body comes in
+    db.session.close()
+    try:
+        stream = get_input_stream(request.environ, max_content_length=max_size)
+        sha256, size, created = attachment_store.save(stream, max_size)
+    except (TooLarge, RequestEntityTooLarge):
+        return too_large
+    if not size:
+        return jsonify({'error': 'Empty upload'}), 400
     
-    message = Message(
-        sender_id=current_user.id,
-        recipient_id=recipient_id,
-        content=content
+    attachment = Attachment(
+        sha256=sha256,
+        size=size,
+        content_type=request.mimetype or 'application/octet-stream',
+        filename=secure_filename(request.args.get('filename', ''))[:255] or 'attachment',
+        uploader_id=current_user.id
     )
-    db.session.add(message)
+    db.session.add(attachment)
     db.session.commit()
-    
-    # Emit message to recipient via WebSocket
-    socketio.emit('new_message', {
-        'message': message.to_dict()
-    }, room=f'user_{recipient_id}')
-    
-    return jsonify(message.to_dict()), 201
+    attachment_uploads.inc(deduplicated='false' if created else 'true')
+    return jsonify(attachment.to_dict()), 201
+
+@main.route('/api/attachments/<int:attachment_id>')
+@login_required
+def download_attachment(attachment_id):
+    """Serve an attachment to the people it was sent to
+
+    Supports Range and conditional requests. The file is handed to the
+    server's ``wsgi.file_wrapper`` (sendfile(2) under gunicorn), or to the
+    front end with ``USE_X_SENDFILE``, rather than read through Python.
+    """
+    attachment = db.session.get(Attachment, attachment_id)
+    if attachment is None or not can_read_attachment(current_user.id, attachment):
+        return jsonify({'error': 'Attachment not found'}), 404
+    content_type = attachment.content_type
+    inline = content_type in INLINE_CONTENT_TYPES or content_type.startswith(INLINE_CONTENT_PREFIXES)
+    response = send_file(
+        attachment_store.path(attachment.sha256),
+        mimetype=content_type,
+        as_attachment=not inline,
+        download_name=attachment.filename,
+        conditional=True,
+        etag=attachment.sha256,
+        max_age=current_app.config['ATTACHMENT_CACHE_MAX_AGE']
+    )
+    # The content behind an id never changes, but only its recipients may
+    # see it: cache in the browser for good, never in shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+# Background work
+_background_tasks = {}
+_background_lock = threading.Lock()
+
+def ensure_background_task(name, target):
+    """Start ``target(app)`` once per process on the Socket.IO async backend"""
+    with _background_lock:
+        if name not in _background_tasks:
+            _background_tasks[name] = socketio.start_background_task(target, current_app._get_current_object())
+
+# Presence
+def load_contact_ids(user_id):
+    """Ids of everyone ``user_id`` has a direct conversation with
+
+    Groups are left out; presence in a large group would fan out to every
+    member on each status change.
+    """
+    conversation_ids = db.session.query(ConversationMember.conversation_id).join(
+        Conversation, Conversation.id == ConversationMember.conversation_id
+    ).filter(ConversationMember.user_id == user_id, Conversation.low_user_id.isnot(None))
+    rows = db.session.query(ConversationMember.user_id).filter(
+        ConversationMember.conversation_id.in_(conversation_ids),
+        ConversationMember.user_id != user_id
+    )
+    return {row[0] for row in rows}
+
+class PresenceWorker(db.Model):
+    """A worker sharing presence; its users count while it heartbeats
+
+    ``version`` goes up whenever the worker changes its users' rows.
+    """
+    id = db.Column(db.String(32), primary_key=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class WorkerPresence(db.Model):
+    """A user with at least one socket on a worker"""
+    __tablename__ = 'worker_presence'
+    worker_id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, index=True)
+
+def heartbeat_presence():
+    """Mark this worker alive and drop the rows of workers that stopped
+
+    A worker seen for the first time, or after it was given up on, writes
+    out all of its users again.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=current_app.config['PRESENCE_WORKER_TIMEOUT'])
+    alive = db.session.execute(update(PresenceWorker).where(PresenceWorker.id == presence.worker_id)
+                               .values(heartbeat_at=now)).rowcount
+    stopped = db.select(PresenceWorker.id).where(PresenceWorker.heartbeat_at < cutoff)
+    db.session.execute(delete(WorkerPresence).where(WorkerPresence.worker_id.in_(stopped)))
+    db.session.execute(delete(PresenceWorker).where(PresenceWorker.heartbeat_at < cutoff))
+    if not alive:
+        db.session.add(PresenceWorker(id=presence.worker_id, heartbeat_at=now))
+        db.session.execute(delete(WorkerPresence).where(WorkerPresence.worker_id == presence.worker_id))
+        online = presence.online_user_ids()
+        if online:
+            db.session.execute(insert(WorkerPresence), [
+                {'worker_id': presence.worker_id, 'user_id': user_id} for user_id in online
+            ])
+    db.session.commit()
+
+def share_presence(changes):
+    """Record this worker's presence ``changes`` and load who is online elsewhere
+
+    Returns the changes to announce: a user who went offline here but still
+    has a socket on another worker stays online. Each worker commits its
+    own change before it looks, so the last to let a user go sees them gone.
+    The users online elsewhere are only reloaded when another worker's
+    version, or the set of live workers, has changed.
+    """
+    worker_id = presence.worker_id
+    if changes:
+        db.session.execute(delete(WorkerPresence).where(
+            WorkerPresence.worker_id == worker_id, WorkerPresence.user_id.in_(list(changes))
+        ))
+        online = [user_id for user_id, is_online in changes.items() if is_online]
+        if online:
+            db.session.execute(insert(WorkerPresence), [
+                {'worker_id': worker_id, 'user_id': user_id} for user_id in online
+            ])
+        db.session.execute(update(PresenceWorker).where(PresenceWorker.id == worker_id)
+                           .values(version=PresenceWorker.version + 1))
+        db.session.commit()
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['PRESENCE_WORKER_TIMEOUT'])
+    workers = frozenset(db.session.query(PresenceWorker.id, PresenceWorker.version).filter(
+        PresenceWorker.id != worker_id, PresenceWorker.heartbeat_at >= cutoff
+    ).all())
+    if workers != presence.remote_source:
+        rows = db.session.query(WorkerPresence.user_id).filter(
+            WorkerPresence.worker_id.in_([worker for worker, _ in workers])
+        ).distinct()
+        presence.set_remote((row[0] for row in rows), workers)
+    db.session.commit()
+    return {
+        user_id: is_online for user_id, is_online in changes.items()
+        if is_online or not presence.is_online(user_id)
+    }
+
+def publish_presence_changes():
+    """Tell each changed user's contacts about the new state, one emit per user"""
+    changes = presence.pop_changes()
+    if current_app.config['PRESENCE_SHARED']:
+        changes = share_presence(changes)
+    for user_id, is_online in changes.items():
+        contacts = presence.contacts(user_id, load_contact_ids)
+        if contacts:
+            socketio.emit('presence', {
+                'user_id': user_id,
+                'is_online': is_online,
+                'last_seen': datetime.utcnow()
+            }, to=[f'user_{contact_id}' for contact_id in contacts])
+            emit_fanout.observe(len(contacts), event='presence')
+        if not is_online:
+            presence.forget_contacts(user_id)
+
+def save_presence(last_online=None):
+    """Write pending online flags and last_seen times in one batch
+
+    Pass the set returned last time: the directory, which shows last_seen,
+    is only reloaded when the users online have changed since then.
+    """
+    unsaved = presence.pop_unsaved()
+    online = presence.all_online_user_ids()
+    if unsaved:
+        # Online anywhere, not only on this worker
+        db.session.execute(update(User), [
+            {'id': user_id, 'is_online': presence.is_online(user_id), 'last_seen': last_seen}
+            for user_id, (_, last_seen) in unsaved.items()
+        ])
+        db.session.commit()
+        # Bulk updates skip the session hooks
+        for user_id in unsaved:
+            user_cache.invalidate(user_id)
+    if online != last_online:
+        directory.invalidate()
+    return online
+
+def presence_worker(app):
+    last_saved = time.monotonic()
+    last_online = None
+    # Workers sharing presence register on the first pass
+    last_heartbeat = float('-inf')
+    while True:
+        socketio.sleep(app.config['PRESENCE_COALESCE_WINDOW'])
+        with app.app_context():
+            try:
+                if app.config['PRESENCE_SHARED'] and \
+                        time.monotonic() - last_heartbeat >= app.config['PRESENCE_FLUSH_INTERVAL']:
+                    heartbeat_presence()
+                    last_heartbeat = time.monotonic()
+                publish_presence_changes()
+                if time.monotonic() - last_saved >= app.config['PRESENCE_FLUSH_INTERVAL']:
+                    last_online = save_presence(last_online)
+                    last_saved = time.monotonic()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Presence update failed')
+
+# Read receipts
+def queue_read_receipt(reader_id, peer_id, up_to):
+    if read_receipts.mark(reader_id, peer_id, up_to):
+        ensure_background_task('read_receipts', read_receipt_worker)
+
+def queue_group_read_receipt(reader_id, conversation_id, up_to):
+    if group_read_receipts.mark(reader_id, conversation_id, up_to):
+        ensure_background_task('read_receipts', read_receipt_worker)
+
+def flush_read_receipts():
+    """Save buffered read watermarks in one transaction, then notify senders"""
+    pending = read_receipts.pop()
+    group_pending = group_read_receipts.pop()
+    if not pending and not group_pending:
+        return
+    try:
+        receipts = save_read_watermarks(pending) if pending else []
+        group_receipts = save_group_watermarks(group_pending) if group_pending else {}
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        read_receipts.restore(pending)
+        group_read_receipts.restore(group_pending)
+        raise
+    stick_to_primary({reader_id for reader_id, _, _ in receipts} |
+                     {receipt['user_id'] for readers in group_receipts.values() for receipt in readers})
+    for reader_id, peer_id, up_to in receipts:
+        socketio.emit('read_receipt', {'user_id': reader_id, 'up_to': up_to}, to=f'user_{peer_id}')
+        emit_fanout.observe(1, event='read_receipt')
+    # One emit per group per flush, however many members read
+    for conversation_id, readers in group_receipts.items():
+        socketio.emit('read_receipt', {
+            'conversation_id': conversation_id, 'receipts': readers
+        }, to=f'conversation_{conversation_id}')
+        emit_fanout.observe(1, event='read_receipt')
+
+def read_receipt_worker(app):
+    while True:
+        socketio.sleep(app.config['READ_RECEIPT_FLUSH_INTERVAL'])
+        with app.app_context():
+            try:
+                flush_read_receipts()
+            except Exception:
+                app.logger.exception('Saving read receipts failed')
 
 # WebSocket events
-@socketio.on('connect')
-def handle_connect():
+@socket_event('connect')
+def handle_connect(auth=None):
+    sockets_connected.inc()
     if current_user.is_authenticated:
         join_room(f'user_{current_user.id}')
-        current_user.is_online = True
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
-        emit('status', {'msg': f'{current_user.username} connected'}, broadcast=True)
+        for conversation_id in load_user_groups(current_user.id):
+            join_room(f'conversation_{conversation_id}')
+        presence.connect(current_user.id)
+        ensure_background_task('presence', presence_worker)
+        if current_app.config['SOCKETIO_MESSAGE_QUEUE']:
+            ensure_background_task('membership', membership_worker)
 
-@socketio.on('disconnect')
+@socket_event('disconnect')
 def handle_disconnect():
+    sockets_connected.dec()
     if current_user.is_authenticated:
         leave_room(f'user_{current_user.id}')
-        current_user.is_online = False
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
-        emit('status', {'msg': f'{current_user.username} disconnected'}, broadcast=True)
+        presence.disconnect(current_user.id)
+    typing_tracker.forget(request.sid)
+
+@socket_event('send_message')
+def handle_send_message(data):
+    if not current_user.is_authenticated:
+        return
+    
+    fields, error = parse_new_message(data)
+    if error:
+        emit('message_ack', {'client_id': data.get('client_id') if isinstance(data, dict) else None, 'error': error})
+        return
+    client_id = fields['client_id']
+    
+    sid = request.sid
+    
+    def acknowledge(pending):
+        deliver_message(pending)
+        ack = {'client_id': client_id}
+        if pending.error:
+            ack['error'] = pending.error[0]
+        else:
+            ack['message'] = pending.payload
+        socketio.emit('message_ack', ack, to=sid)
+    
+    message_writer.submit(current_user.id, callback=acknowledge, **fields)
+
+@socket_event('join_conversation')
+def handle_join_conversation(data):
+    """Subscribe this socket to a group it was added to after connecting"""
+    if not current_user.is_authenticated:
+        return
+    if not isinstance(data, dict):
+        return {'error': 'Join request must be a JSON object'}
+    try:
+        conversation_id = int(data.get('conversation_id'))
+    except (TypeError, ValueError):
+        return
+    if current_user.id in load_group_members(conversation_id):
+        join_room(f'conversation_{conversation_id}')
+
+@socket_event('mark_read')
+def handle_mark_read(data):
+    if not current_user.is_authenticated:
+        return
+    if not isinstance(data, dict):
+        return {'error': 'Read receipt must be a JSON object'}
+    try:
+        up_to = int(data.get('up_to'))
+        if data.get('conversation_id') is not None:
+            conversation_id, peer_id = int(data.get('conversation_id')), None
+        else:
+            conversation_id, peer_id = None, int(data.get('user_id'))
+    except (TypeError, ValueError):
+        return
+    if up_to < 1:
+        return
+    if conversation_id is None:
+        queue_read_receipt(current_user.id, peer_id, up_to)
+    elif current_user.id in load_group_members(conversation_id):
+        queue_group_read_receipt(current_user.id, conversation_id, up_to)
 
-@socketio.on('typing')
+@socket_event('typing')
 def handle_typing(data):
-    if current_user.is_authenticated:
-        recipient_id = data.get('recipient_id')
-        is_typing = data.get('is_typing', False)
+    if current_user.is_authenticated and typing_tracker.allow(request.sid):
+        try:
+            recipient_id = int(data.get('recipient_id'))
+        except (TypeError, ValueError):
+            return
+        is_typing = bool(data.get('is_typing', False))
+        if not typing_tracker.update(current_user.id, recipient_id, is_typing):
+            return
         
+        # The recipient hides the indicator itself once expires_in has passed
         emit('typing_status', {
             'user_id': current_user.id,
             'username': current_user.username,
-            'is_typing': is_typing
+            'is_typing': is_typing,
+            'expires_in': int(typing_tracker.ttl * 1000)
         }, room=f'user_{recipient_id}')
+        emit_fanout.observe(1, event='typing_status')
+
+
+# Application factory
+def create_app(config_name=None, overrides=None):
+    """Build and configure the app
 
-# Initialize database and create sample users
-def create_tables():
-    db.create_all()
+    ``config_name`` picks a class from config.py (default: FLASK_ENV, then
+    development) and ``overrides`` is applied on top, all before any
+    extension is initialized. Nothing touches the database here; create the
+    schema with ``python database_setup.py``.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config[config_name or os.environ.get('FLASK_ENV') or 'default'])
+    if overrides:
+        app.config.update(overrides)
+    app.json = serializer.FastJSONProvider(app)
     
-    # Create sample users if none exist
-    if not User.query.first():
-        sample_users = [
-            {
-                'username': 'john_doe',
-                'email': 'john@example.com',
-                'password': 'password123',
-                'avatar': 'https://images.unsplash.com/photo-1507003211169-0a1dd7228f2d?w=100&h=100&fit=crop&crop=face'
-            },
-            {
-                'username': 'sarah_johnson',
-                'email': 'sarah@example.com',
-                'password': 'password123',
-                'avatar': 'https://images.unsplash.com/photo-1494790108755-2616b332765c?w=100&h=100&fit=crop&crop=face'
-            },
-            {
-                'username': 'mike_chen',
-                'email': 'mike@example.com',
-                'password': 'password123',
-                'avatar': 'https://images.unsplash.com/photo-1472099645785-5658abf4ff4e?w=100&h=100&fit=crop&crop=face'
-            }
-        ]
-        
-        for user_data in sample_users:
-            user = User(
-                username=user_data['username'],
-                email=user_data['email'],
-                avatar=user_data['avatar']
-            )
-            user.set_password(user_data['password'])
-            db.session.add(user)
-        
-        db.session.commit()
+    db.init_app(app)
+    app.extensions['read_replicas'] = [
+        create_engine(url, **engine_options(url)) for url in app.config['SQLALCHEMY_REPLICA_URLS']
+    ]
+    login_manager.init_app(app)
+    
+    socketio_options = {
+        'cors_allowed_origins': app.config['SOCKETIO_CORS_ALLOWED_ORIGINS'],
+        'async_mode': app.config['SOCKETIO_ASYNC_MODE'],
+    }
+    # Cross-process fan-out so every worker can reach every user_<id> room
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if message_queue and message_queue.startswith('unix://'):
+        socketio_options['client_manager'] = LocalBrokerManager(message_queue)
+    elif message_queue:
+        socketio_options['message_queue'] = message_queue
+    socketio.init_app(app, **socketio_options)
+    
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+    directory.ttl = app.config['DIRECTORY_CACHE_TTL']
+    for cache in (group_members, user_groups):
+        cache.maxsize = app.config['MEMBERSHIP_CACHE_SIZE']
+        cache.ttl = app.config['MEMBERSHIP_CACHE_TTL']
+    typing_tracker.ttl = app.config['TYPING_TTL']
+    typing_tracker.rate = app.config['TYPING_EVENTS_PER_SECOND']
+    typing_tracker.burst = app.config['TYPING_BURST']
+    recent_writers.maxsize = app.config['USER_CACHE_SIZE']
+    recent_writers.ttl = app.config['REPLICA_STICKY_SECONDS']
+    attachment_store.root = app.config['UPLOAD_FOLDER']
+    rate_limiter.configure(
+        backend_from_url(app.config['RATELIMIT_STORAGE_URL']),
+        app.config['RATELIMIT_LIMITS'],
+        app.config['RATELIMIT_DEFAULT']
+    )
+    message_writer.persist = functools.partial(persist_messages, app)
+    message_writer.batch_size = app.config['MESSAGE_BATCH_SIZE']
+    message_writer.logger = app.logger
+    message_writer.bind(socketio.server.eio)
+    
+    app.register_blueprint(main)
+    return app
 
 if __name__ == '__main__':
-    with app.app_context():
-        create_tables()
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(create_app(), debug=True, host='0.0.0.0', port=5000)
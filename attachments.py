@@ -0,0 +1,67 @@
+"""
+Content-addressed storage for message attachments.
+
+Each file is stored once under its SHA-256, however many times it is
+uploaded. Uploads are copied from the request stream to disk in fixed-size
+chunks and hashed on the way, so a worker holds one chunk of a file in
+memory, never the whole body, and under eventlet every read from the
+client yields to other green threads.
+"""
+
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class TooLarge(Exception):
+    """The upload went past the size limit"""
+
+
+class AttachmentStore:
+    """Files named by their SHA-256 below ``root``, as ``ab/cd/abcd...``"""
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def save(self, stream, max_size, chunk_size=CHUNK_SIZE):
+        """Copy ``stream`` to the store; returns ``(sha256, size, created)``
+
+        ``created`` is False if the same content was already stored. Raises
+        :class:`TooLarge`, keeping nothing, once more than ``max_size``
+        bytes have been read.
+        """
+        incoming = os.path.join(self.root, 'incoming')
+        os.makedirs(incoming, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        handle, temp_path = tempfile.mkstemp(dir=incoming)
+        try:
+            with os.fdopen(handle, 'wb') as temp:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise TooLarge(max_size)
+                    digest.update(chunk)
+                    temp.write(chunk)
+            sha256 = digest.hexdigest()
+            target = self.path(sha256)
+            if os.path.exists(target):
+                return sha256, size, False
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Atomic on one filesystem: readers see the whole file or none
+            os.replace(temp_path, target)
+            return sha256, size, True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
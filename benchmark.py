@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the HTTP and Socket.IO hot paths
+
+Seeds users and messages, then drives each scenario from concurrent simulated
+clients through Flask's and Flask-SocketIO's test clients and prints one JSON
+document: latency percentiles, throughput and SQL statements per call.
+
+    python benchmark.py --users 1000 --messages 100000 --clients 20 --output run.json
+    python benchmark.py --compare baseline.json run.json
+
+Runs against a throwaway SQLite database unless BENCHMARK_DATABASE_URL is set.
+The report also times worker startup: importing app.py and create_app() in
+fresh interpreters, measures socket latency during a login storm, times
+group sends as the group grows (--group-sizes), times the rate limiter
+check every request and socket event pays and tracks the memory a
+conversation export takes as the conversation grows (--export-sizes).
+Set SOCKETIO_ASYNC_MODE=eventlet to run everything on green threads, as
+gunicorn's eventlet worker does.
+"""
+
+import os
+
+if __name__ == '__main__' and os.environ.get('SOCKETIO_ASYNC_MODE') == 'eventlet':
+    # Patch before anything imports threading or socket
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import contextlib
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from flask import session
+from sqlalchemy import event, insert
+from werkzeug.security import generate_password_hash
+from app import create_app, db, socketio, User, Message, conversation_key
+from config import Config, engine_options
+
+SEED_BATCH_SIZE = 10000
+PASSWORD = 'benchmark'
+
+
+class SimulatedClient:
+    """One seeded user with a logged-in HTTP session and, once needed, a socket"""
+
+    def __init__(self, app, user_id, email, peer_id):
+        self.app = app
+        self.user_id = user_id
+        self.email = email
+        self.peer_id = peer_id
+        self.http = app.test_client()
+        with self.http.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        self._socket = None
+
+    @property
+    def socket(self):
+        if self._socket is None:
+            self._socket = socketio.test_client(self.app, flask_test_client=self.http)
+        return self._socket
+
+    def close(self):
+        if self._socket is not None and self._socket.is_connected():
+            self._socket.disconnect()
+
+
+def seed(app, users, messages):
+    """Insert ``users`` users and ``messages`` messages; return the user ids
+
+    Messages go round-robin from each user to the next few, so every user
+    has history with its neighbour.
+    """
+    from database_setup import backfill_conversations
+    tag = uuid.uuid4().hex[:8]
+    # Hashing once keeps seeding fast; every user shares the password
+    password_hash = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(User), [
+            {'username': f'b{tag}_{i}', 'email': f'b{tag}_{i}@example.com', 'password_hash': password_hash}
+            for i in range(users)
+        ])
+        db.session.commit()
+        user_ids = [row[0] for row in db.session.query(User.id).filter(
+            User.username.like(f'b{tag}_%')
+        ).order_by(User.id)]
+
+        for start in range(0, messages, SEED_BATCH_SIZE):
+            rows = []
+            for k in range(start, min(start + SEED_BATCH_SIZE, messages)):
+                sender = user_ids[k % users]
+                recipient = user_ids[(k % users + 1 + (k // users) % 3) % users]
+                low_user_id, high_user_id = conversation_key(sender, recipient)
+                rows.append({
+                    'sender_id': sender, 'recipient_id': recipient, 'content': f'benchmark message {k}',
+                    'low_user_id': low_user_id, 'high_user_id': high_user_id, 'is_read': False
+                })
+            db.session.execute(insert(Message), rows)
+            db.session.commit()
+        backfill_conversations()
+    return user_ids, tag
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class StatementCounter:
+    """Counts SQL statements from every thread, background tasks included"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+
+def run_scenario(call, clients, iterations, counter):
+    """Run ``call(client, i)`` ``iterations`` times from each client at once
+
+    ``call`` returns an HTTP status code, or None for socket events; codes of
+    400 and up count as errors.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(len(clients) + 1)
+
+    def worker(client):
+        own = []
+        failed = 0
+        start_barrier.wait()
+        for i in range(iterations):
+            started = time.perf_counter()
+            try:
+                status = call(client, i)
+            except Exception:
+                status = 599
+            own.append(time.perf_counter() - started)
+            if status is not None and status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(own)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    statements_before = counter.count
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'errors': sum(errors),
+        'seconds': round(elapsed, 4),
+        'throughput': round(calls / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'queries_per_call': round((counter.count - statements_before) / calls, 2),
+    }
+
+
+# Each scenario is called as ``call(client, i)``
+def _login(client, i):
+    response = client.app.test_client().post('/login', data={'email': client.email, 'password': PASSWORD})
+    # A failed login re-renders the form with a 200; success redirects
+    return 200 if response.status_code == 302 else 401
+
+def _users(client, i):
+    return client.http.get('/api/users').status_code
+
+def _messages(client, i):
+    return client.http.get(f'/api/messages/{client.peer_id}').status_code
+
+def _send_message(client, i):
+    response = client.http.post('/api/send_message', json={
+        'recipient_id': client.peer_id, 'content': f'benchmark reply {i}'
+    })
+    return response.status_code
+
+def _socket_connect(client, i):
+    socket = socketio.test_client(client.app, flask_test_client=client.http)
+    socket.disconnect()
+
+def _typing(client, i):
+    client.socket.emit('typing', {'recipient_id': client.peer_id, 'is_typing': True})
+
+SCENARIOS = {
+    'login': _login,
+    'api_users': _users,
+    'api_messages': _messages,
+    'api_send_message': _send_message,
+    'socket_connect': _socket_connect,
+    'socket_typing': _typing,
+}
+
+
+def run_benchmark(app, users=200, messages=20000, clients=10, iterations=20, scenarios=None,
+                  startup_runs=0, login_storm=True, group_sizes=(), export_sizes=()):
+    """Seed ``app``'s database, run the scenarios and return the report as a dict"""
+    seeded_at = time.perf_counter()
+    # Keep progress output from the seeding helpers out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        user_ids, tag = seed(app, users, messages)
+    seed_seconds = time.perf_counter() - seeded_at
+
+    clients = min(clients, users)
+    simulated = [
+        SimulatedClient(app, user_ids[i], f'b{tag}_{i}@example.com', user_ids[(i + 1) % users])
+        for i in range(clients)
+    ]
+    counter = StatementCounter()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', counter)
+    # Simulated logins post the form without a CSRF token
+    csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['WTF_CSRF_ENABLED'] = False
+    results = {}
+    storm = None
+    fanout = {}
+    try:
+        for name in scenarios or SCENARIOS:
+            results[name] = run_scenario(SCENARIOS[name], simulated, iterations, counter)
+        if login_storm:
+            probe = SimulatedClient(app, user_ids[-1], f'b{tag}_{users - 1}@example.com', user_ids[0])
+            simulated.append(probe)
+            storm = run_login_storm(simulated[:clients], iterations, probe, counter)
+        fanout = {
+            str(size): run_group_fanout(app, user_ids[:size], tag, iterations, counter)
+            for size in group_sizes if 2 <= size <= users
+        }
+    finally:
+        app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+        event.remove(engine, 'before_cursor_execute', counter)
+        for client in simulated:
+            client.close()
+
+    report = {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'database': engine.dialect.name,
+            'async_mode': socketio.async_mode,
+            'users': users,
+            'messages': messages,
+            'clients': clients,
+            'iterations': iterations,
+            'seed_seconds': round(seed_seconds, 2),
+        },
+        'scenarios': results,
+    }
+    if storm:
+        report['login_storm'] = storm
+    if fanout:
+        report['group_fanout'] = fanout
+    report['rate_limit'] = measure_rate_limit(app, threads=clients)
+    if export_sizes and users >= 2:
+        report['export'] = measure_export(app, simulated[0], user_ids[1], export_sizes)
+    if startup_runs:
+        report['startup'] = measure_startup(startup_runs)
+    return report
+
+
+def _latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'samples': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+def run_login_storm(clients, iterations, probe, counter, interval=0.01, idle_samples=50):
+    """Log ``clients`` in ``iterations`` times each while ``probe`` keeps emitting
+
+    The probe sends a typing event every ``interval`` seconds and records how
+    late each one completes against its schedule, first on its own and then
+    during the storm. A login that hashes on the event loop shows up here as
+    latency for every socket.
+    """
+    def probe_once():
+        due = time.perf_counter() + interval
+        time.sleep(interval)
+        probe.socket.emit('typing', {'recipient_id': probe.peer_id, 'is_typing': True})
+        return time.perf_counter() - due
+
+    idle = [probe_once() for _ in range(idle_samples)]
+    during = []
+    stop = threading.Event()
+
+    def keep_probing():
+        while not stop.is_set():
+            during.append(probe_once())
+
+    prober = threading.Thread(target=keep_probing)
+    prober.start()
+    try:
+        logins = run_scenario(_login, clients, iterations, counter)
+    finally:
+        stop.set()
+        prober.join()
+    return {
+        'logins': logins,
+        'probe_idle': _latency_summary(idle),
+        'probe_during_storm': _latency_summary(during or [0.0]),
+    }
+
+
+def run_group_fanout(app, member_ids, tag, iterations, counter):
+    """Send ``iterations`` messages to a group of ``member_ids``, all connected
+
+    Times each send from the HTTP call until every member's socket has the
+    message. A group message is one insert and one emit to the group's room
+    whatever the group's size, so queries per send should stay flat.
+    """
+    with app.app_context():
+        emails = dict(db.session.query(User.id, User.email).filter(User.id.in_(member_ids)))
+    members = [SimulatedClient(app, user_id, emails[user_id], None) for user_id in member_ids]
+    try:
+        sender = members[0]
+        response = sender.http.post('/api/conversations', json={
+            'title': f'b{tag} x{len(members)}', 'member_ids': list(member_ids)
+        })
+        conversation_id = response.get_json()['id']
+        for member in members:
+            member.socket.get_received()
+        latencies = []
+        missed = 0
+        statements_before = counter.count
+        for i in range(iterations):
+            started = time.perf_counter()
+            response = sender.http.post('/api/send_message', json={
+                'conversation_id': conversation_id, 'content': f'benchmark group message {i}'
+            })
+            message_id = response.get_json()['id']
+            for member in members:
+                packets = member.socket.get_received()
+                if not any(packet['name'] == 'new_message' and packet['args'][0]['message']['id'] == message_id
+                           for packet in packets):
+                    missed += 1
+            latencies.append(time.perf_counter() - started)
+        summary = _latency_summary(latencies)
+        summary['queries_per_send'] = round((counter.count - statements_before) / iterations, 2)
+        summary['missed_deliveries'] = missed
+        return summary
+    finally:
+        for member in members:
+            member.close()
+
+
+def measure_rate_limit(app, checks=20000, threads=4):
+    """Microseconds per rate limit check on the memory backend
+
+    Times the check a request makes before its view runs, in a request
+    context: allowed calls from one thread and from ``threads`` at once,
+    and calls that are turned away.
+    """
+    from app import check_rate_limit, rate_limiter
+    from rate_limit import MemoryBackend, parse_limit
+    enabled, backend = app.config['RATELIMIT_ENABLED'], rate_limiter.backend
+    app.config['RATELIMIT_ENABLED'] = True
+    rate_limiter.backend = MemoryBackend()
+    rate_limiter.limits.update({
+        'benchmark.allowed': parse_limit(f'{checks * threads * 10}/second'),
+        'benchmark.rejected': parse_limit('1/day'),
+    })
+
+    def timed(name, user_id, results):
+        with app.test_request_context('/api/users'):
+            session['_user_id'] = str(user_id)
+            started = time.perf_counter()
+            for _ in range(checks):
+                check_rate_limit(name)
+            results.append((time.perf_counter() - started) / checks * 1e6)
+
+    try:
+        single, concurrent, rejected = [], [], []
+        timed('benchmark.allowed', 0, single)
+        workers = [threading.Thread(target=timed, args=('benchmark.allowed', i + 1, concurrent))
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        timed('benchmark.rejected', 0, rejected)
+    finally:
+        app.config['RATELIMIT_ENABLED'], rate_limiter.backend = enabled, backend
+        rate_limiter.limits.pop('benchmark.allowed', None)
+        rate_limiter.limits.pop('benchmark.rejected', None)
+    return {
+        'checks': checks,
+        'allowed_us': round(single[0], 2),
+        f'allowed_us_{threads}_threads': round(sum(concurrent) / len(concurrent), 2),
+        'rejected_us': round(rejected[0], 2),
+    }
+
+
+def measure_export(app, client, peer_id, sizes):
+    """Stream ``client``'s NDJSON export with ``peer_id`` as the history grows to each of ``sizes``
+
+    Reports the time and the peak Python memory allocated while streaming.
+    The export holds one batch at a time, so the peak should stay flat
+    while the history grows.
+    """
+    results = {}
+    with app.app_context():
+        have = Message.between(client.user_id, peer_id).count()
+    low_user_id, high_user_id = conversation_key(client.user_id, peer_id)
+    for size in sorted(sizes):
+        with app.app_context():
+            for start in range(have, size, SEED_BATCH_SIZE):
+                db.session.execute(insert(Message), [
+                    {'sender_id': client.user_id, 'recipient_id': peer_id, 'content': f'benchmark export {k}',
+                     'low_user_id': low_user_id, 'high_user_id': high_user_id, 'is_read': False}
+                    for k in range(start, min(start + SEED_BATCH_SIZE, size))
+                ])
+                db.session.commit()
+        have = max(have, size)
+        tracemalloc.start()
+        started = time.perf_counter()
+        response = client.http.get(f'/api/export/{peer_id}', buffered=False)
+        lines = sum(chunk.count(b'\n') for chunk in response.response)
+        response.close()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[str(size)] = {
+            'messages': lines,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(lines / elapsed) if elapsed else None,
+            'peak_kib': round(peak / 1024),
+        }
+    return results
+
+
+STARTUP_SCRIPT = '''
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(imported - started, time.perf_counter() - imported)
+'''
+
+def measure_startup(runs=5, env=None):
+    """Time ``runs`` cold worker starts, each in a fresh interpreter
+
+    Reports median milliseconds for importing app.py, for create_app() and
+    for the whole process including interpreter startup.
+    """
+    imports, creates, processes = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env, capture_output=True, text=True, check=True
+        )
+        processes.append(time.perf_counter() - started)
+        imported, created = map(float, result.stdout.split()[-2:])
+        imports.append(imported)
+        creates.append(created)
+    return {
+        'runs': runs,
+        'import_ms': round(percentile(sorted(imports), 0.5) * 1000, 1),
+        'create_app_ms': round(percentile(sorted(creates), 0.5) * 1000, 1),
+        'process_ms': round(percentile(sorted(processes), 0.5) * 1000, 1),
+    }
+
+
+def compare(baseline, current):
+    """Print each scenario's p50/p95/throughput change from ``baseline`` to ``current``"""
+    print(f"{'scenario':<20} {'p50 ms':>18} {'p95 ms':>18} {'throughput':>20}")
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        cells = [f"{before[key]:>8} → {now[key]:<8}" for key in ('p50_ms', 'p95_ms', 'throughput')]
+        print(f"{name:<20} " + ' '.join(cells))
+    if 'login_storm' in baseline and 'login_storm' in current:
+        before, now = baseline['login_storm'], current['login_storm']
+        print(f"\n{'login storm':<20} {'logins/s':>18} {'probe p95 ms':>18} {'probe max ms':>20}")
+        cells = [
+            f"{before['logins']['throughput']:>8} → {now['logins']['throughput']:<8}",
+            f"{before['probe_during_storm']['p95_ms']:>8} → {now['probe_during_storm']['p95_ms']:<8}",
+            f"{before['probe_during_storm']['max_ms']:>8} → {now['probe_during_storm']['max_ms']:<8}",
+        ]
+        print(f"{'':<20} " + ' '.join(cells))
+    shared = [size for size in current.get('group_fanout', {}) if size in baseline.get('group_fanout', {})]
+    if shared:
+        print(f"\n{'group fan-out':<20} {'p50 ms':>18} {'p95 ms':>18} {'queries/send':>20}")
+        for size in shared:
+            before, now = baseline['group_fanout'][size], current['group_fanout'][size]
+            cells = [f"{before[key]:>8} → {now[key]:<8}" for key in ('p50_ms', 'p95_ms', 'queries_per_send')]
+            print(f"{size + ' members':<20} " + ' '.join(cells))
+    if 'rate_limit' in baseline and 'rate_limit' in current:
+        before, now = baseline['rate_limit'], current['rate_limit']
+        print(f"\n{'rate limit check':<20} {'allowed us':>18} {'rejected us':>18}")
+        cells = [f"{before[key]:>8} → {now[key]:<8}" for key in ('allowed_us', 'rejected_us')]
+        print(f"{'':<20} " + ' '.join(cells))
+    shared = [size for size in current.get('export', {}) if size in baseline.get('export', {})]
+    if shared:
+        print(f"\n{'export':<20} {'seconds':>18} {'peak KiB':>18}")
+        for size in shared:
+            before, now = baseline['export'][size], current['export'][size]
+            cells = [f"{before[key]:>8} → {now[key]:<8}" for key in ('seconds', 'peak_kib')]
+            print(f"{size + ' messages':<20} " + ' '.join(cells))
+    if 'startup' in baseline and 'startup' in current:
+        cells = [f"{baseline['startup'][key]:>8} → {current['startup'][key]:<8}"
+                 for key in ('import_ms', 'create_app_ms', 'process_ms')]
+        print(f"\n{'startup':<20} {'import ms':>18} {'create_app ms':>18} {'process ms':>20}")
+        print(f"{'':<20} " + ' '.join(cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the chat app hot paths')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=10, help='concurrent simulated clients')
+    parser.add_argument('--iterations', type=int, default=20, help='calls per client and scenario')
+    parser.add_argument('--scenarios', help='comma separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='cold starts to time; 0 skips the startup measurement')
+    parser.add_argument('--group-sizes', default='10,100,1000',
+                        help='comma separated group sizes to time sends for, capped at --users')
+    parser.add_argument('--export-sizes', default='1000,100000',
+                        help='comma separated conversation lengths to time an export at')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='compare two saved reports and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as baseline, open(args.compare[1]) as current:
+            compare(json.load(baseline), json.load(current))
+        sys.exit(0)
+
+    names = args.scenarios.split(',') if args.scenarios else None
+    unknown = set(names or []) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    database_url = os.environ.get('BENCHMARK_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    app = create_app('testing', {
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(database_url),
+        'SOCKETIO_ASYNC_MODE': os.environ.get('SOCKETIO_ASYNC_MODE') or 'threading',
+        # Log in against the real hashing cost, not the testing shortcut
+        'PASSWORD_HASH_METHOD': Config.PASSWORD_HASH_METHOD,
+    })
+    group_sizes = [int(size) for size in args.group_sizes.split(',') if size]
+    export_sizes = [int(size) for size in args.export_sizes.split(',') if size]
+    report = run_benchmark(app, args.users, args.messages, args.clients, args.iterations, names, args.startup_runs,
+                           group_sizes=group_sizes, export_sizes=export_sizes)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"Wrote {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
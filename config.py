@@ -1,5 +1,30 @@
 import os
 from datetime import timedelta
+from dotenv import load_dotenv
+
+# Before the classes below read the environment
+load_dotenv()
+
+def engine_options(database_uri):
+    """SQLAlchemy pool settings from the environment
+
+    Each worker opens at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections; past
+    that, requests wait up to DB_POOL_TIMEOUT seconds for one to come back
+    instead of opening more. Size it so that workers x (size + overflow)
+    stays under the server's max_connections. SQLite keeps the defaults.
+    """
+    if database_uri.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE') or 5),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or 5),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT') or 10),
+        # Replace connections before server or proxy idle timeouts close them
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE') or 1800),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'True').lower() == 'true',
+        # Reuse the most recent connection so idle ones can time out server-side
+        'pool_use_lifo': True,
+    }
 
 class Config:
     # Basic Flask configuration
@@ -11,7 +36,15 @@ class Config:
         database_url = database_url.replace('postgres://', 'postgresql://', 1)
     SQLALCHEMY_DATABASE_URI = database_url or 'sqlite:///chat.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_RECORD_QUERIES = True
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # Read replicas (comma separated URLs) for inbox, history and search
+    # reads; everything else, and every write, uses the primary above
+    SQLALCHEMY_REPLICA_URLS = [
+        url.strip().replace('postgres://', 'postgresql://', 1)
+        for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+    ]
+    # After a user writes, their reads stay on the primary this long (seconds)
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
     
     # Session configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
@@ -20,9 +53,88 @@ class Config:
     SESSION_COOKIE_SAMESITE = 'Lax'
     
     # File upload configuration
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    # Attachments are stored here by content hash and only served through
+    # /api/attachments, so keep it out of static/
+    UPLOAD_FOLDER = os.path.abspath(os.environ.get('UPLOAD_FOLDER') or
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+    # Largest ordinary request body; attachments stream to disk and have
+    # their own limit
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH') or 16 * 1024 * 1024)
+    ATTACHMENT_MAX_SIZE = int(os.environ.get('ATTACHMENT_MAX_SIZE') or 1024 * 1024 * 1024)
+    # Downloads are immutable per id; browsers may keep them this long (seconds)
+    ATTACHMENT_CACHE_MAX_AGE = int(os.environ.get('ATTACHMENT_CACHE_MAX_AGE') or 365 * 24 * 3600)
+    # Let the front end send files (X-Sendfile, for Apache or lighttpd)
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'False').lower() == 'true'
     
+    # Message history pagination
+    MESSAGES_PAGE_SIZE = int(os.environ.get('MESSAGES_PAGE_SIZE') or 50)
+    MESSAGES_MAX_PAGE_SIZE = int(os.environ.get('MESSAGES_MAX_PAGE_SIZE') or 200)
+    # Rows fetched per round trip when streaming an export
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+
+    # Cache of logged-in user snapshots behind Flask-Login's user loader
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL') or 60)
+
+    # Group conversations: the largest group, and the per-process cache of
+    # who is in which group (seconds before another worker's change shows)
+    GROUP_MAX_MEMBERS = int(os.environ.get('GROUP_MAX_MEMBERS') or 5000)
+    MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE') or 10000)
+    MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL') or 30)
+    # With a message queue, how often each worker applies membership
+    # changes made through the others (seconds)
+    MEMBERSHIP_SYNC_INTERVAL = float(os.environ.get('MEMBERSHIP_SYNC_INTERVAL') or 1.0)
+
+    # User directory (/api/users) paging, and how long each worker serves
+    # its cached copy before reloading it (seconds)
+    DIRECTORY_PAGE_SIZE = int(os.environ.get('DIRECTORY_PAGE_SIZE') or 50)
+    DIRECTORY_MAX_PAGE_SIZE = int(os.environ.get('DIRECTORY_MAX_PAGE_SIZE') or 200)
+    DIRECTORY_CACHE_TTL = float(os.environ.get('DIRECTORY_CACHE_TTL') or 30)
+
+    # Message search page sizes
+    SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE') or 20)
+    SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE') or 100)
+
+    # Retention: messages older than this many days move to message_archive
+    # when `python database_setup.py archive` runs (0 keeps everything hot),
+    # at most MESSAGE_ARCHIVE_BATCH_SIZE per transaction
+    MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS') or 90)
+    MESSAGE_ARCHIVE_BATCH_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_BATCH_SIZE') or 5000)
+
+    # Most new messages written per transaction by the write-behind queue
+    MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE') or 500)
+
+    # Typing indicators: how long one "is typing" lasts at the recipient
+    # (seconds), and each connection's typing event budget
+    TYPING_TTL = float(os.environ.get('TYPING_TTL') or 6.0)
+    TYPING_EVENTS_PER_SECOND = float(os.environ.get('TYPING_EVENTS_PER_SECOND') or 2.0)
+    TYPING_BURST = int(os.environ.get('TYPING_BURST') or 5)
+
+    # Presence: how long status changes are coalesced before they are sent,
+    # and how often last_seen is written back to the database (seconds)
+    PRESENCE_COALESCE_WINDOW = float(os.environ.get('PRESENCE_COALESCE_WINDOW') or 1.0)
+    PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL') or 30.0)
+    # Share presence between workers through the database; on by default
+    # with a message queue. A worker that stops heartbeating (every flush
+    # interval) for PRESENCE_WORKER_TIMEOUT seconds no longer counts
+    PRESENCE_SHARED = (os.environ.get('PRESENCE_SHARED') or
+                       str(bool(os.environ.get('SOCKETIO_MESSAGE_QUEUE')))).lower() == 'true'
+    PRESENCE_WORKER_TIMEOUT = float(os.environ.get('PRESENCE_WORKER_TIMEOUT') or 90.0)
+
+    # Read receipts: how often buffered read watermarks are saved (seconds)
+    READ_RECEIPT_FLUSH_INTERVAL = float(os.environ.get('READ_RECEIPT_FLUSH_INTERVAL') or 1.0)
+
+    # Metrics: statements slower than this are logged (seconds), and
+    # /metrics wants "Authorization: Bearer <METRICS_TOKEN>" if it is set
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 0.25)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Password hashing: a Werkzeug method with its cost, e.g. scrypt:32768:8:1
+    # or pbkdf2:sha256:600000. Raising it upgrades each stored hash at its
+    # owner's next login. Hashing runs on the async library's OS thread pool
+    # (EVENTLET_THREADPOOL_SIZE threads under eventlet, 20 by default)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+
     # Mail configuration (for future features)
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
@@ -44,18 +156,42 @@ class Config:
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
     LOG_FILE = os.environ.get('LOG_FILE', 'app.log')
     
-    # Rate limiting
+    # Rate limiting: a token bucket per user (per client address before
+    # login) and per route endpoint or "socket.<event>". A budget of
+    # "60/minute" allows bursts of 60 and refills at one a second; None
+    # exempts. Anything not listed gets RATELIMIT_DEFAULT. Storage is
+    # memory:// (per worker) or redis://host:6379/0 (shared by all workers).
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'True').lower() == 'true'
     RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
     RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT', '1000/hour')
+    RATELIMIT_LIMITS = {
+        'main.login': os.environ.get('RATELIMIT_LOGIN') or '10/minute',
+        'main.register': os.environ.get('RATELIMIT_REGISTER') or '5/minute',
+        'main.send_message': os.environ.get('RATELIMIT_SEND_MESSAGE') or '60/minute',
+        'socket.send_message': os.environ.get('RATELIMIT_SEND_MESSAGE') or '60/minute',
+        'main.upload_attachment': os.environ.get('RATELIMIT_UPLOAD') or '30/minute',
+        'main.export_messages': os.environ.get('RATELIMIT_EXPORT') or '10/hour',
+        'socket.connect': os.environ.get('RATELIMIT_CONNECT') or '30/minute',
+        'socket.mark_read': '600/minute',
+        # Typing has its own per-socket budget, see TYPING_EVENTS_PER_SECOND
+        'socket.typing': None,
+        'socket.disconnect': None,
+        'static': None,
+        'main.prometheus_metrics': None,
+    }
     
     # WebSocket configuration
-    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+    # eventlet, gevent or threading; unset picks the first one installed
+    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE')
+    # Pub/sub backend shared by all workers: redis://host:6379/0, amqp://...,
+    # or unix:///tmp/chat-broker.sock for the bundled local_broker.py
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
     SOCKETIO_CORS_ALLOWED_ORIGINS = os.environ.get('SOCKETIO_CORS_ALLOWED_ORIGINS', '*')
 
 class DevelopmentConfig(Config):
     DEBUG = True
     TESTING = False
-    SQLALCHEMY_ECHO = True
+    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO', 'False').lower() == 'true'
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -76,8 +212,13 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
-    LOGIN_DISABLED = True
+    # Cheap hashes keep tests and benchmarks that create users fast
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    # Every test client shares one address; tests turn it on where needed
+    RATELIMIT_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+    SQLALCHEMY_REPLICA_URLS = []
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
 
 # Configuration dictionary
 config = {
@@ -2,15 +2,45 @@
 """
 Database setup script for Flask Chat App
 Creates tables and initializes sample data
+
+The app never creates or changes the schema by itself; run one of
+
+    python database_setup.py                          # tables and sample users
+    python database_setup.py create-tables            # tables only
+    python database_setup.py migrate                  # upgrade an existing database
+    python database_setup.py backfill-conversations
+    python database_setup.py archive                  # move messages past retention
+    python database_setup.py export USER_ID OTHER_ID [FILE.ndjson|FILE.csv]
+    python database_setup.py reset                    # drop everything, then as above
 """
 
+import contextlib
 import os
-from app import app, db, User
-from datetime import datetime
+import sys
+from flask import current_app, has_app_context
+from sqlalchemy import delete, insert, inspect, text
+from app import (create_app, db, User, Message, MessageArchive, Conversation, ConversationMember, snippet,
+                 create_search_index, export_batches, EXPORT_FIELDS)
+from export import encode_export
+from datetime import datetime, timedelta
+
+MIGRATION_BATCH_SIZE = 10000
+
+def app_context():
+    """The caller's app context if there is one, else a fresh app's"""
+    if has_app_context():
+        return contextlib.nullcontext()
+    return create_app().app_context()
+
+def create_tables():
+    """Create missing tables and indexes, without sample data"""
+    with app_context():
+        db.create_all()
+        print("Database tables created successfully!")
 
 def init_database():
     """Initialize database with tables and sample data"""
-    with app.app_context():
+    with app_context():
         print("Setting up database...")
         
         # Create all tables
@@ -86,15 +116,243 @@ def init_database():
 
 def reset_database():
     """Reset database - drop all tables and recreate"""
-    with app.app_context():
+    with app_context():
         print("Resetting database...")
         db.drop_all()
         init_database()
 
-if __name__ == '__main__':
-    import sys
+def _add_missing_columns(table):
+    """Add model columns that an older database does not have yet"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        print(f"  Added column {table.name}.{column.name}")
+    db.session.commit()
+
+def _backfill_conversation_keys():
+    """Fill Message.low_user_id/high_user_id in bounded batches"""
+    max_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+    updated = 0
+    for start in range(0, max_id + 1, MIGRATION_BATCH_SIZE):
+        result = db.session.execute(text(
+            'UPDATE message SET '
+            'low_user_id = CASE WHEN sender_id <= recipient_id THEN sender_id ELSE recipient_id END, '
+            'high_user_id = CASE WHEN sender_id <= recipient_id THEN recipient_id ELSE sender_id END '
+            'WHERE low_user_id IS NULL AND recipient_id IS NOT NULL AND id >= :start AND id < :end'
+        ), {'start': start, 'end': start + MIGRATION_BATCH_SIZE})
+        db.session.commit()
+        updated += result.rowcount
+    print(f"  Backfilled conversation keys for {updated} messages")
+
+def _allow_group_messages(table):
+    """Drop NOT NULL from ``table.recipient_id``; group messages have no recipient"""
+    columns = {column['name']: column for column in inspect(db.engine).get_columns(table.name)}
+    if columns['recipient_id']['nullable']:
+        return
+    if db.engine.dialect.name != 'sqlite':
+        db.session.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN recipient_id DROP NOT NULL'))
+        db.session.commit()
+    else:
+        # SQLite cannot change a column's constraints: rebuild the table
+        old_name = f'{table.name}_old'
+        columns = ', '.join(column.name for column in table.columns)
+        with db.engine.begin() as connection:
+            for trigger in ('message_fts_insert', 'message_fts_delete', 'message_fts_update'):
+                connection.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+            for index in inspect(connection).get_indexes(table.name):
+                connection.execute(text(f'DROP INDEX {index["name"]}'))
+            connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {old_name}'))
+            table.create(connection)
+            connection.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}'))
+            connection.execute(text(f'DROP TABLE {old_name}'))
+            if table is Message.__table__ and inspect(connection).has_table('message_fts'):
+                connection.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+    print(f"  Allowed group messages in {table.name}")
+
+def _ensure_search_index():
+    """Create the message search index, indexing existing history if it is new"""
+    is_new = db.engine.dialect.name == 'sqlite' and not inspect(db.engine).has_table('message_fts')
+    with db.engine.begin() as connection:
+        create_search_index(connection)
+        if is_new:
+            # External-content FTS5 tables are filled from the message table
+            connection.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+    print("  Ensured message search index")
+
+def migrate_database():
+    """Bring an existing database up to the current schema in place"""
+    with app_context():
+        print("Migrating database...")
+        db.create_all()
+        
+        for table in (Message.__table__, MessageArchive.__table__, Conversation.__table__,
+                      ConversationMember.__table__):
+            _add_missing_columns(table)
+        _allow_group_messages(Message.__table__)
+        _allow_group_messages(MessageArchive.__table__)
+        _backfill_conversation_keys()
+        
+        for table in (Message.__table__, MessageArchive.__table__):
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+            print(f"  Ensured {len(table.indexes)} {table.name} indexes")
+        
+        _ensure_search_index()
+        
+        print("\nDatabase migration complete!")
+
+def backfill_conversations():
+    """Build conversation summaries for message history that predates them"""
+    with app_context():
+        print("Backfilling conversation summaries...")
+        db.create_all()
+        
+        existing = set(db.session.query(Conversation.low_user_id, Conversation.high_user_id))
+        pairs = [
+            (low, high, last_id)
+            for low, high, last_id in db.session.query(
+                Message.low_user_id, Message.high_user_id, db.func.max(Message.id)
+            ).filter(Message.conversation_id.is_(None)).group_by(Message.low_user_id, Message.high_user_id)
+            if (low, high) not in existing
+        ]
+        unread = {
+            (low, high, recipient_id): count
+            for low, high, recipient_id, count in db.session.query(
+                Message.low_user_id, Message.high_user_id, Message.recipient_id, db.func.count(Message.id)
+            ).filter(Message.is_read == False, Message.conversation_id.is_(None)).group_by(
+                Message.low_user_id, Message.high_user_id, Message.recipient_id
+            )
+        }
+        
+        batch_size = 1000
+        for start in range(0, len(pairs), batch_size):
+            chunk = pairs[start:start + batch_size]
+            last_messages = {
+                message.id: message
+                for message in Message.query.filter(Message.id.in_([last_id for _, _, last_id in chunk]))
+            }
+            for low, high, last_id in chunk:
+                last_message = last_messages[last_id]
+                conversation = Conversation(
+                    low_user_id=low,
+                    high_user_id=high,
+                    last_message_id=last_id,
+                    last_message_snippet=snippet(last_message.content),
+                    last_message_at=last_message.timestamp
+                )
+                db.session.add(conversation)
+                db.session.flush()
+                for user_id in {low, high}:
+                    db.session.add(ConversationMember(
+                        conversation_id=conversation.id,
+                        user_id=user_id,
+                        unread_count=unread.get((low, high, user_id), 0)
+                    ))
+            db.session.commit()
+        
+        print(f"Created {len(pairs)} conversation summaries ({len(existing)} already existed)")
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+def _ensure_archive_partitions(first, last):
+    """Create the monthly message_archive partitions covering ``first``..``last`` (Postgres)"""
+    month = _month_start(first)
+    while month <= last:
+        following = _month_start(month + timedelta(days=32))
+        db.session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS message_archive_{month:%Y_%m} PARTITION OF message_archive '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        ))
+        month = following
+
+def archive_messages(retention_days=None, batch_size=None):
+    """Move messages older than the retention window into message_archive
+
+    Walks the hot table once along its primary key, one short transaction
+    per batch, so no batch holds locks for long and readers and writers
+    carry on in between. The newest message always stays, so SQLite never
+    hands out an archived id again.
+    """
+    with app_context():
+        retention_days = current_app.config['MESSAGE_RETENTION_DAYS'] if retention_days is None else retention_days
+        batch_size = batch_size or current_app.config['MESSAGE_ARCHIVE_BATCH_SIZE']
+        if not retention_days:
+            print("Retention is off (MESSAGE_RETENTION_DAYS=0); nothing to archive")
+            return 0
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        print(f"Archiving messages from before {cutoff:%Y-%m-%d %H:%M}...")
+        db.create_all()
+        
+        newest_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+        partitioned = db.engine.dialect.name == 'postgresql'
+        archived = 0
+        last_id = 0
+        while True:
+            old = db.session.query(Message.id, Message.timestamp).filter(
+                Message.id > last_id, Message.id < newest_id, Message.timestamp < cutoff
+            ).order_by(Message.id).limit(batch_size).all()
+            if not old:
+                break
+            last_id = old[-1].id
+            if partitioned:
+                _ensure_archive_partitions(min(row.timestamp for row in old), max(row.timestamp for row in old))
+            ids = [row.id for row in old]
+            columns = [column.name for column in MessageArchive.__table__.columns]
+            db.session.execute(insert(MessageArchive).from_select(
+                columns, db.select(*(Message.__table__.c[name] for name in columns)).where(Message.id.in_(ids))
+            ))
+            db.session.execute(delete(Message).where(Message.id.in_(ids)))
+            db.session.commit()
+            archived += len(ids)
+            print(f"  Archived {archived} messages (through id {last_id})")
+        
+        print(f"Archived {archived} messages")
+        return archived
+
+def export_conversation(user_id, other_id, path=None):
+    """Write the whole conversation between two users to ``path``, or stdout
+
+    The format follows the file's extension: CSV for ``.csv``, NDJSON
+    otherwise. Rows are streamed from the database like ``/api/export``, so
+    memory use doesn't grow with the conversation.
+    """
+    fmt = 'csv' if path and path.lower().endswith('.csv') else 'ndjson'
+    exported = 0
+    
+    def counted(batches):
+        nonlocal exported
+        for rows in batches:
+            exported += len(rows)
+            yield rows
     
-    if len(sys.argv) > 1 and sys.argv[1] == 'reset':
+    with app_context():
+        batches = export_batches(Message.between(user_id, other_id), MessageArchive.between(user_id, other_id))
+        with (open(path, 'wb') if path else contextlib.nullcontext(sys.stdout.buffer)) as output:
+            for chunk in encode_export(counted(batches), EXPORT_FIELDS, fmt):
+                output.write(chunk)
+    # stdout may be the export itself
+    print(f"Exported {exported} messages between users {user_id} and {other_id}", file=sys.stderr)
+    return exported
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'reset':
         reset_database()
+    elif command == 'create-tables':
+        create_tables()
+    elif command == 'migrate':
+        migrate_database()
+    elif command == 'backfill-conversations':
+        backfill_conversations()
+    elif command == 'archive':
+        archive_messages()
+    elif command == 'export':
+        if len(sys.argv) not in (4, 5):
+            sys.exit("usage: database_setup.py export USER_ID OTHER_ID [FILE.ndjson|FILE.csv]")
+        export_conversation(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] if len(sys.argv) == 5 else None)
     else:
         init_database()
\ No newline at end of file
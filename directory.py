@@ -0,0 +1,83 @@
+"""
+Cached user directory.
+
+The directory is loaded once into a list sorted by lowercase username and
+served from memory until something invalidates it or it expires. Prefix
+search is a binary search and a page costs O(limit), however many users
+there are.
+
+Sign-ups and profile edits handled by another worker show up here when
+the snapshot expires.
+"""
+
+import bisect
+import threading
+import time
+
+
+class DirectoryCache:
+    """Serialized directory entries plus a version bumped on every invalidation
+
+    :param loader: Returns an iterable of entry dicts, each with ``id`` and
+                   ``username``; called with no arguments on a cache miss.
+    :param ttl: Seconds a loaded snapshot is served before it is reloaded.
+    """
+
+    def __init__(self, loader, ttl=30.0):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loaded_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self.version += 1
+
+    def snapshot(self):
+        """Return ``(entries, keys, positions)``, loading them on a miss"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.hits += 1
+            return snapshot
+        self.misses += 1
+        version = self.version
+        loaded_at = time.monotonic()
+        entries = sorted(self.loader(), key=lambda entry: entry['username'].lower())
+        keys = [entry['username'].lower() for entry in entries]
+        positions = {entry['id']: index for index, entry in enumerate(entries)}
+        snapshot = (entries, keys, positions)
+        with self._lock:
+            # Drop the result if an invalidation raced with the load
+            if self.version == version:
+                self._snapshot = snapshot
+                self._loaded_at = loaded_at
+        return snapshot
+
+    def page(self, prefix='', offset=0, limit=50, exclude_id=None):
+        """Return up to ``limit`` entries whose username starts with ``prefix``
+
+        Returns ``(entries, has_more)``. ``exclude_id`` (the viewer) is
+        skipped without counting towards the offset.
+        """
+        entries, keys, positions = self.snapshot()
+        prefix = prefix.lower()
+        first = bisect.bisect_left(keys, prefix)
+        start = first + offset
+        excluded = positions.get(exclude_id)
+        if excluded is not None and first <= excluded <= start:
+            start += 1
+        
+        page = []
+        index = start
+        while index < len(entries) and keys[index].startswith(prefix):
+            if index != excluded:
+                if len(page) == limit:
+                    return page, True
+                page.append(entries[index])
+            index += 1
+        return page, False
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Local message broker for running several Socket.IO workers on one machine
+without Redis.
+
+Start the broker, then point every worker at the same socket file:
+
+    python local_broker.py /tmp/chat-broker.sock
+    SOCKETIO_MESSAGE_QUEUE=unix:///tmp/chat-broker.sock gunicorn ...
+
+Every frame a worker publishes is relayed to all subscribed workers, which
+is all a python-socketio pub/sub client manager needs.
+"""
+
+import os
+import pickle
+import socketserver
+import struct
+import threading
+import time
+
+import socketio
+
+FRAME_HEADER = struct.Struct('!I')
+PUBLISHER = b'P'
+SUBSCRIBER = b'S'
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('broker connection closed')
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """Read one length-prefixed frame from ``sock``"""
+    (size,) = FRAME_HEADER.unpack(_recv_exact(sock, FRAME_HEADER.size))
+    return _recv_exact(sock, size)
+
+
+def write_frame(sock, payload):
+    """Write one length-prefixed frame to ``sock``"""
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def socket_path(url):
+    """Turn a ``unix:///path/to/broker.sock`` URL into a filesystem path"""
+    return url[len('unix://'):] if url.startswith('unix://') else url
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        role = _recv_exact(self.request, 1)
+        if role == SUBSCRIBER:
+            self.server.add_subscriber(self.request)
+            # Hold the connection open until the worker goes away
+            while self.request.recv(1):
+                pass
+            self.server.remove_subscriber(self.request)
+        elif role == PUBLISHER:
+            try:
+                while True:
+                    self.server.relay(read_frame(self.request))
+            except OSError:
+                pass
+
+
+class LocalBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Relays every published frame to every subscriber"""
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, _BrokerHandler)
+        self.path = path
+        self.subscribers = {}
+
+    def add_subscriber(self, sock):
+        self.subscribers[sock] = threading.Lock()
+
+    def remove_subscriber(self, sock):
+        self.subscribers.pop(sock, None)
+
+    def relay(self, payload):
+        for sock, lock in list(self.subscribers.items()):
+            try:
+                with lock:
+                    write_frame(sock, payload)
+            except OSError:
+                self.remove_subscriber(sock)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class LocalBrokerManager(socketio.PubSubManager):
+    """Socket.IO client manager that talks to a :class:`LocalBroker`
+
+    :param url: The broker socket, as ``unix:///path/to/broker.sock``.
+    """
+    name = 'local'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = socket_path(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self, role):
+        socket_module = self._socket_module()
+        sock = socket_module.socket(socket_module.AF_UNIX, socket_module.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(role)
+        return sock
+
+    def _socket_module(self):
+        # Without monkey patching a plain socket would block the eventlet hub
+        if self.server is not None and self.server.async_mode == 'eventlet':
+            from eventlet.green import socket as green_socket
+            return green_socket
+        import socket
+        return socket
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(PUBLISHER)
+                    return write_frame(self._publisher, payload)
+                except OSError:
+                    self._publisher = None
+                    if attempt:
+                        self._get_logger().error('Cannot publish to local broker at %s', self.path)
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(SUBSCRIBER)
+            except OSError:
+                self._get_logger().error('Cannot reach local broker at %s... retrying', self.path)
+                self._sleep(1)
+                continue
+            try:
+                while True:
+                    yield read_frame(sock)
+            except OSError:
+                self._get_logger().error('Lost connection to local broker... reconnecting')
+            finally:
+                sock.close()
+
+    def _sleep(self, seconds):
+        if self.server is not None:
+            self.server.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+
+def run_broker(path):
+    broker = LocalBroker(path)
+    print(f"Local Socket.IO broker listening on {path}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    run_broker(socket_path(sys.argv[1] if len(sys.argv) > 1 else '/tmp/chat-broker.sock'))
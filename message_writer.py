@@ -0,0 +1,128 @@
+"""
+Write-behind queue for new messages.
+
+Senders enqueue messages and return straight away. A single background task
+drains whatever has queued up, persists it in one transaction and only then
+runs each message's callback (ack + fan-out). Under load a commit covers many
+messages instead of one.
+"""
+
+import threading
+
+
+class PendingMessage:
+    """A message waiting to be persisted, and its outcome once it has been"""
+    __slots__ = ('sender_id', 'recipient_id', 'conversation_id', 'content', 'attachment_id', 'client_id',
+                 'callback', 'payload', 'error', 'duplicate')
+
+    def __init__(self, sender_id, recipient_id, content, callback=None, conversation_id=None, attachment_id=None,
+                 client_id=None):
+        self.sender_id = sender_id
+        # A direct message has a recipient, a group message a conversation
+        self.recipient_id = recipient_id
+        self.conversation_id = conversation_id
+        self.content = content
+        self.attachment_id = attachment_id
+        # The sender's own id for the message, so a resend is saved once
+        self.client_id = client_id
+        self.callback = callback
+        # Filled in by the persist function: the serialized message, or
+        # an (error message, HTTP status) pair, and whether the message had
+        # already been saved under the same client_id
+        self.payload = None
+        self.error = None
+        self.duplicate = False
+
+
+class MessageWriter:
+    """Group-commits queued messages on the Socket.IO async backend
+
+    :param backend: The Engine.IO server, which supplies queues, events and
+                    background tasks that match the configured async mode.
+                    May be given later through :meth:`bind`.
+    :param persist: Called with a list of :class:`PendingMessage`; stores them
+                    in one transaction and sets ``payload`` or ``error``.
+    :param batch_size: The most messages written per transaction.
+    """
+
+    def __init__(self, backend=None, persist=None, batch_size=500, logger=None):
+        self.persist = persist
+        self.batch_size = batch_size
+        self.logger = logger
+        self.backend = None
+        self._queue = None
+        self._task = None
+        self._start_lock = threading.Lock()
+        if backend is not None:
+            self.bind(backend)
+
+    def bind(self, backend):
+        """Use ``backend`` for the queue and the writer task; call before submitting"""
+        self.backend = backend
+        self._queue = backend.create_queue()
+        self._task = None
+
+    def submit(self, sender_id, recipient_id, content, callback=None, conversation_id=None, attachment_id=None,
+               client_id=None):
+        """Queue a message; ``callback(pending)`` runs once it is committed"""
+        pending = PendingMessage(sender_id, recipient_id, content, callback, conversation_id, attachment_id,
+                                 client_id)
+        self._queue.put(pending)
+        if self._task is None:
+            with self._start_lock:
+                if self._task is None:
+                    self._task = self.backend.start_background_task(self.run)
+        return pending
+
+    def send(self, sender_id, recipient_id, content, callback=None, timeout=10, conversation_id=None,
+             attachment_id=None, client_id=None):
+        """Queue a message and wait until it has been committed"""
+        done = self.backend.create_event()
+        
+        def finish(pending):
+            try:
+                if callback is not None:
+                    callback(pending)
+            finally:
+                done.set()
+        
+        pending = self.submit(sender_id, recipient_id, content, finish, conversation_id, attachment_id, client_id)
+        if not done.wait(timeout):
+            pending.error = ('Timed out saving message', 503)
+        return pending
+
+    def backlog(self):
+        """Messages queued but not yet picked up by the writer"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def next_batch(self):
+        """Block for one message, then take whatever else is already queued"""
+        batch = [self._queue.get()]
+        empty = self.backend.get_queue_empty_exception()
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except empty:
+                break
+        return batch
+
+    def write(self, batch):
+        try:
+            self.persist(batch)
+        except Exception:
+            if self.logger:
+                self.logger.exception('Saving %d messages failed', len(batch))
+            for pending in batch:
+                pending.payload = None
+                pending.error = ('Could not save message', 500)
+        for pending in batch:
+            if pending.callback is not None:
+                try:
+                    pending.callback(pending)
+                except Exception:
+                    if self.logger:
+                        self.logger.exception('Message callback failed')
+
+    def run(self):
+        while True:
+            self.write(self.next_batch())
@@ -0,0 +1,52 @@
+"""
+Password hashing with a configurable cost.
+
+Hashes are Werkzeug's ``method$salt$hash`` strings, so a stored hash records
+the method and cost it was made with. Logins compare that against the
+configured method and re-hash passwords made with an outdated one.
+
+Hashing is deliberately slow CPU work. Under eventlet or gevent it would
+block the hub, and every socket with it, so :func:`offload` moves it onto
+the async library's pool of OS threads; hashlib releases the GIL while it
+hashes.
+"""
+
+import functools
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+@functools.lru_cache(maxsize=None)
+def _method_prefix(method):
+    # Werkzeug fills in default parameters ("scrypt" -> "scrypt:32768:8:1");
+    # hash once to learn what a current hash starts with
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash, method):
+    """True if ``password_hash`` was not made with ``method`` at its current cost"""
+    return password_hash.split('$', 1)[0] != _method_prefix(method)
+
+
+def verify(password_hash, password, method):
+    """Check ``password``; returns ``(ok, new_hash)``
+
+    ``new_hash`` is set when the password is right but ``password_hash`` is
+    outdated, and should replace it.
+    """
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash, method):
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+def offload(async_mode, func, *args):
+    """Call ``func(*args)`` on an OS thread if ``async_mode`` uses green threads"""
+    if async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args)
+    if async_mode == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
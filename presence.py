@@ -0,0 +1,127 @@
+"""
+In-memory presence tracking for connected users.
+
+Socket connects and disconnects only touch this registry. Status changes are
+coalesced and handed out in batches, so a user flapping between tabs costs
+nothing, and ``last_seen`` is written back to the database lazily.
+
+The registry only counts this process's sockets. When several workers
+share presence, the app also hands it the users online on the others, see
+:meth:`PresenceRegistry.set_remote`.
+"""
+
+import threading
+import uuid
+from datetime import datetime
+
+
+class PresenceRegistry:
+    """Per-process connection refcounts and pending presence changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._announced = {}
+        self._pending = {}
+        self._unsaved = {}
+        self._contacts = {}
+        # Users with a socket on another worker, and the shared state they
+        # were loaded from
+        self._remote = frozenset()
+        self.remote_source = None
+        # Bumped whenever anyone comes online or goes offline
+        self.version = 0
+        self.worker_id = uuid.uuid4().hex
+
+    def connect(self, user_id):
+        """Record a new socket for ``user_id``; True if the user just came online"""
+        with self._lock:
+            count = self._connections.get(user_id, 0) + 1
+            self._connections[user_id] = count
+            if count == 1:
+                self.version += 1
+                self._pending[user_id] = True
+                self._unsaved[user_id] = (True, datetime.utcnow())
+            return count == 1
+
+    def disconnect(self, user_id):
+        """Drop one socket for ``user_id``; True if that was the last one"""
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+                return False
+            self._connections.pop(user_id, None)
+            self.version += 1
+            self._pending[user_id] = False
+            self._unsaved[user_id] = (False, datetime.utcnow())
+            return True
+
+    def is_online(self, user_id):
+        return user_id in self._connections or user_id in self._remote
+
+    def set_remote(self, user_ids, source=None):
+        """Replace the set of users online on other workers
+
+        ``source`` is kept as :attr:`remote_source`, so the caller can tell
+        when the shared state has moved on and the set needs reloading.
+        """
+        user_ids = frozenset(user_ids)
+        with self._lock:
+            self.remote_source = source
+            if user_ids != self._remote:
+                self._remote = user_ids
+                self.version += 1
+
+    def online_user_ids(self):
+        """Users with a socket on this worker"""
+        with self._lock:
+            return set(self._connections)
+
+    def all_online_user_ids(self):
+        """Users with a socket on this worker or, as far as it knows, another"""
+        with self._lock:
+            return frozenset(self._connections) | self._remote
+
+    def pop_changes(self):
+        """Return ``{user_id: is_online}`` for states that changed since the last call
+
+        A user who went offline and came back within one window never shows up.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            changes = {}
+            for user_id, is_online in pending.items():
+                if self._announced.get(user_id, False) != is_online:
+                    self._announced[user_id] = is_online
+                    changes[user_id] = is_online
+                if not is_online:
+                    self._announced.pop(user_id, None)
+            return changes
+
+    def pop_unsaved(self):
+        """Return ``{user_id: (is_online, last_seen)}`` not yet written to the database"""
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {}
+            return unsaved
+
+    def contacts(self, user_id, loader):
+        """Return the cached contact ids of ``user_id``, loading them on first use"""
+        contacts = self._contacts.get(user_id)
+        if contacts is None:
+            contacts = set(loader(user_id))
+            with self._lock:
+                self._contacts[user_id] = contacts
+        return contacts
+
+    def forget_contacts(self, user_id):
+        with self._lock:
+            self._contacts.pop(user_id, None)
+
+    def add_contact(self, user_id, other_id):
+        """Keep cached contact sets current when two users talk for the first time"""
+        with self._lock:
+            if user_id in self._contacts:
+                self._contacts[user_id].add(other_id)
+            if other_id in self._contacts:
+                self._contacts[other_id].add(user_id)
@@ -0,0 +1,135 @@
+"""
+Token-bucket rate limiting for routes and Socket.IO events.
+
+Every (budget name, client) pair has a bucket that holds up to ``count``
+tokens and refills at ``count`` per period; each call spends one. Budgets
+are written like ``"60/minute"``.
+
+Buckets live in memory, per process, or in Redis when several workers must
+share them. The memory backend takes no lock: under eventlet nothing runs
+between its read and its write, and with OS threads a race can let an
+extra call through, which is cheaper than every call queueing on a lock.
+"""
+
+import math
+import re
+import time
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+_LIMIT = re.compile(r'^\s*(\d+)\s*(?:/|per)\s*(second|minute|hour|day)s?\s*$')
+
+
+def parse_limit(limit):
+    """``"60/minute"`` -> ``(rate per second, burst)``; None or ``""`` -> None"""
+    if not limit:
+        return None
+    match = _LIMIT.match(limit.lower())
+    if match is None:
+        raise ValueError(f'Invalid rate limit: {limit!r}')
+    count = int(match.group(1))
+    return count / PERIODS[match.group(2)], count
+
+
+class MemoryBackend:
+    """Buckets in a dict, for a single worker
+
+    :param maxsize: Past this many buckets, full ones are dropped; a full
+                    bucket is the same as no bucket.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = {}
+
+    def hit(self, key, rate, burst, now=None):
+        """Spend a token; returns the tokens left, negative if there were none"""
+        now = time.monotonic() if now is None else now
+        tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - updated) * rate) - 1
+        # Don't charge rejected calls, or a client that keeps retrying
+        # would never get through
+        kept = tokens + 1 if tokens < 0 else tokens
+        self._buckets[key] = (kept, now, now + (burst - kept) / rate)
+        if len(self._buckets) > self.maxsize:
+            self._sweep(now)
+        return tokens
+
+    def _sweep(self, now):
+        for key, (_, _, full_at) in list(self._buckets.items()):
+            if full_at <= now:
+                self._buckets.pop(key, None)
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RedisBackend:
+    """Buckets in Redis, shared by every worker; needs ``pip install redis``
+
+    Each check is one round trip running a script, so the read and the
+    write are atomic and all workers go by the Redis server's clock.
+    """
+
+    SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+local kept = tokens
+if tokens < 0 then kept = tokens + 1 end
+redis.call('HSET', KEYS[1], 'tokens', kept, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(tokens)
+"""
+
+    def __init__(self, url, prefix='ratelimit:'):
+        import redis
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def hit(self, key, rate, burst, now=None):
+        return float(self._script(keys=[self.prefix + key], args=[rate, burst]))
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + '*'):
+            self._client.delete(key)
+
+
+def backend_from_url(url):
+    """``memory://`` or ``redis://...`` (also ``rediss://``, ``unix://``)"""
+    if not url or url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f'Unsupported rate limit storage: {url!r}')
+
+
+class RateLimiter:
+    """Named budgets over a backend
+
+    :param limits: ``{name: "count/period"}``; None exempts that name.
+    :param default: Budget for names not in ``limits``; None for no limit.
+    """
+
+    def __init__(self, backend=None, limits=None, default=None):
+        self.configure(backend or MemoryBackend(), limits, default)
+
+    def configure(self, backend, limits=None, default=None):
+        self.backend = backend
+        self.default = parse_limit(default)
+        self.limits = {name: parse_limit(limit) for name, limit in (limits or {}).items()}
+
+    def hit(self, name, identity, now=None):
+        """Spend one of ``identity``'s calls to ``name``; returns seconds to wait, 0 if allowed"""
+        limit = self.limits.get(name, self.default)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        tokens = self.backend.hit(f'{name}:{identity}', rate, burst, now)
+        if tokens >= 0:
+            return 0
+        return math.ceil(-tokens / rate * 1000) / 1000
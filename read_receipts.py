@@ -0,0 +1,50 @@
+"""
+Buffered read receipts.
+
+Clients report "read up to message id" watermarks as they scroll. Reports only
+touch this buffer; a background task drains it and writes every watermark
+that moved in one transaction, so reading never competes with sending.
+"""
+
+import threading
+
+
+class ReadReceiptBuffer:
+    """Highest unflushed read watermark per ``(reader_id, peer_id)``"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.reported = 0
+
+    def mark(self, reader_id, peer_id, up_to):
+        """Record that ``reader_id`` has read ``peer_id``'s messages up to ``up_to``
+
+        Returns False if an equal or higher watermark is already waiting.
+        """
+        key = (reader_id, peer_id)
+        with self._lock:
+            self.reported += 1
+            if self._pending.get(key, 0) >= up_to:
+                return False
+            self._pending[key] = up_to
+            return True
+
+    def pop(self):
+        """Return and clear ``{(reader_id, peer_id): up_to}``"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            return pending
+
+    def restore(self, pending):
+        """Put watermarks back after a failed flush, keeping any newer ones"""
+        with self._lock:
+            for key, up_to in pending.items():
+                if self._pending.get(key, 0) < up_to:
+                    self._pending[key] = up_to
+
+    def __len__(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'reported': self.reported}
@@ -4,18 +4,13 @@ Flask Chat App - Main entry point
 Run with: python run.py
 """
 
-from app import app, socketio, db
-from config import config
+from app import create_app, socketio
 import os
 
-# Get configuration from environment
+# Get configuration from environment. The schema is not touched here:
+# create it once with `python database_setup.py`
 config_name = os.environ.get('FLASK_ENV', 'development')
-app.config.from_object(config[config_name])
-
-# Create tables if they don't exist
-with app.app_context():
-    db.create_all()
-    print("Database tables created successfully!")
+app = create_app(config_name)
 
 if __name__ == '__main__':
     # Get host and port from environment or use defaults
@@ -0,0 +1,63 @@
+"""
+JSON encoding for API responses and Socket.IO packets.
+
+Uses orjson when it is installed and the standard library otherwise. Either
+way datetimes are written as ISO 8601, so serializers hand over datetime
+objects as they are instead of formatting each one, and non-string dict
+keys (such as user ids) become strings.
+"""
+
+import json
+from datetime import date
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+else:
+    def dumps_bytes(obj):
+        return dumps(obj).encode()
+
+    def loads(data, **kwargs):
+        return json.loads(data)
+
+
+def dumps(obj, **kwargs):
+    """Encode ``obj`` compactly; extra arguments such as ``separators`` are ignored"""
+    if orjson is not None:
+        return dumps_bytes(obj).decode()
+    return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False)
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider backed by this module, for ``jsonify`` and ``tojson``"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype='application/json')
@@ -4,7 +4,23 @@ Test database connection and operations
 """
 
 import os
-from app import app, db, User, Message
+import tempfile
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import event, inspect, text
+
+if __name__ != '__main__':
+    # Under pytest, run against a throwaway database unless one is given explicitly
+    os.environ.setdefault('TEST_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test_chat.db'))
+    os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'threading')
+    os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp())
+
+from app import create_app, db, socketio, presence, update_conversations, flush_read_receipts, User, Message, Conversation, ConversationMember
+
+app = create_app('testing' if __name__ != '__main__' else None, {
+    # Tests flush read receipts themselves; keep the background flusher out of the way
+    'READ_RECEIPT_FLUSH_INTERVAL': 3600
+})
 
 def test_database_connection():
     """Test basic database connection"""
@@ -61,6 +77,1154 @@ def test_message_operations():
             print(f"✗ Message operations failed: {e}")
             return False
 
+def _make_user(prefix='user'):
+    """Create a throwaway user with a unique username and email"""
+    name = f'{prefix}_{uuid.uuid4().hex[:8]}'
+    user = User(username=name, email=f'{name}@example.com')
+    user.set_password('password123')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def _logged_in_client(user):
+    """Return a test client with ``user`` logged in"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail if the block runs more than ``limit`` SQL statements"""
+    statements = []
+    
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert len(statements) <= limit, \
+        f'{len(statements)} queries (limit {limit}):\n' + '\n'.join(statements)
+
+def test_message_pagination():
+    """History is served newest page first and walks back by cursor"""
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        for i in range(7):
+            sender, recipient = (alice, bob) if i % 2 == 0 else (bob, alice)
+            db.session.add(Message(sender_id=sender.id, recipient_id=recipient.id, content=f'msg {i}'))
+        db.session.commit()
+        client = _logged_in_client(alice)
+        bob_id = bob.id
+
+    page = client.get(f'/api/messages/{bob_id}?limit=3').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 4', 'msg 5', 'msg 6']
+    assert page['has_more'] is True
+
+    page = client.get(f'/api/messages/{bob_id}?limit=3&before_id={page["next_cursor"]}').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 1', 'msg 2', 'msg 3']
+
+    page = client.get(f'/api/messages/{bob_id}?limit=3&before_id={page["next_cursor"]}').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 0']
+    assert page['has_more'] is False and page['next_cursor'] is None
+
+    newest = client.get(f'/api/messages/{bob_id}?limit=3').get_json()['messages']
+    page = client.get(f'/api/messages/{bob_id}?after_id={newest[0]["id"]}').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 5', 'msg 6']
+    print("✓ Message pagination returns stable keyset pages")
+
+def test_history_query_count_is_constant():
+    """Serializing a page of history must not lazy-load a sender per message"""
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        db.session.add_all([
+            Message(sender_id=bob.id, recipient_id=alice.id, content=f'msg {i}') for i in range(120)
+        ])
+        db.session.commit()
+        client = _logged_in_client(alice)
+        bob_id, alice_id = bob.id, alice.id
+        
+        # The history page and the side-loaded users; load_user is cached,
+        # a full page never reaches the archive and fetching marks nothing read
+        with assert_max_queries(2):
+            page = client.get(f'/api/messages/{bob_id}?limit=100').get_json()
+    
+    assert len(page['messages']) == 100
+    assert 'sender' not in page['messages'][0]
+    assert set(page['users']) == {str(alice_id), str(bob_id)}
+    print("✓ History page serializes with a constant number of queries")
+
+def test_local_broker_relays_between_workers():
+    """A frame published by one worker reaches another worker's listener"""
+    import pickle
+    import threading
+    import time
+    from local_broker import LocalBroker, LocalBrokerManager
+    
+    path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    broker = LocalBroker(path)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    try:
+        sender = LocalBrokerManager(f'unix://{path}')
+        receiver = LocalBrokerManager(f'unix://{path}')
+        received = []
+        listener = receiver._listen()
+        threading.Thread(target=lambda: received.append(next(listener)), daemon=True).start()
+        
+        deadline = time.time() + 5
+        while not broker.subscribers and time.time() < deadline:
+            time.sleep(0.01)
+        message = {'method': 'emit', 'event': 'new_message', 'room': 'user_1', 'host_id': sender.host_id}
+        sender._publish(message)
+        while not received and time.time() < deadline:
+            time.sleep(0.01)
+        
+        assert [pickle.loads(frame) for frame in received] == [message]
+    finally:
+        broker.shutdown()
+        broker.server_close()
+    print("✓ Local broker relays emits between workers")
+
+def test_presence_refcounts_and_coalesces():
+    """Extra tabs do not flap a user's status and quick reconnects are not announced"""
+    from presence import PresenceRegistry
+    registry = PresenceRegistry()
+    assert registry.connect(1) is True
+    assert registry.connect(1) is False
+    assert registry.disconnect(1) is False
+    assert registry.is_online(1)
+    assert registry.pop_changes() == {1: True}
+    
+    registry.disconnect(1)
+    registry.connect(1)
+    assert registry.pop_changes() == {}
+    registry.disconnect(1)
+    assert registry.pop_changes() == {1: False}
+    assert set(registry.pop_unsaved()) == {1}
+    print("✓ Presence registry refcounts connections and coalesces changes")
+
+def test_presence_reaches_contacts_only():
+    """Status changes go to users who share a conversation, not to everyone"""
+    from app import publish_presence_changes, save_presence
+    app.config['PRESENCE_COALESCE_WINDOW'] = 3600
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        message = Message(sender_id=alice.id, recipient_id=bob.id, content='hi')
+        db.session.add(message)
+        db.session.flush()
+        update_conversations([message])
+        db.session.commit()
+        alice_id, bob_id, carol_id = alice.id, bob.id, carol.id
+        http_clients = {user.id: _logged_in_client(user) for user in (alice, bob, carol)}
+    
+    # Socket handlers must run outside the test's app context, or they share its g
+    clients = {user_id: socketio.test_client(app, flask_test_client=client)
+               for user_id, client in http_clients.items()}
+    with app.app_context():
+        publish_presence_changes()
+    
+    assert clients[bob_id].get_received()[-1]['args'][0]['user_id'] == alice_id
+    assert not any(packet['name'] == 'presence' for packet in clients[carol_id].get_received())
+    
+    second_tab = socketio.test_client(app, flask_test_client=http_clients[alice_id])
+    second_tab.disconnect()
+    assert presence.is_online(alice_id)
+    
+    from app import directory
+    with app.app_context():
+        online = save_presence()
+        assert db.session.get(User, alice_id).is_online is True
+        # The directory is only reloaded once someone comes or goes
+        version = directory.version
+        assert save_presence(online) == online and directory.version == version
+    for client in clients.values():
+        client.disconnect()
+    assert not presence.is_online(alice_id)
+    print("✓ Presence changes are delivered to contacts only")
+
+def test_presence_is_shared_between_workers():
+    """Users online on another worker count as online here until that worker stops"""
+    from datetime import datetime, timedelta
+    from app import PresenceWorker, WorkerPresence, heartbeat_presence, publish_presence_changes, save_presence
+    app.config['PRESENCE_COALESCE_WINDOW'] = 3600
+    app.config['PRESENCE_SHARED'] = True
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        message = Message(sender_id=alice.id, recipient_id=bob.id, content='hi')
+        db.session.add(message)
+        db.session.flush()
+        update_conversations([message])
+        now = datetime.utcnow()
+        db.session.add_all([
+            PresenceWorker(id='other', heartbeat_at=now),
+            PresenceWorker(id='stopped', heartbeat_at=now - timedelta(hours=1)),
+            WorkerPresence(worker_id='other', user_id=bob.id),
+            WorkerPresence(worker_id='stopped', user_id=carol.id),
+        ])
+        db.session.commit()
+        alice_id, bob_id, carol_id = alice.id, bob.id, carol.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    try:
+        with app.app_context():
+            heartbeat_presence()
+            publish_presence_changes()
+            assert WorkerPresence.query.filter_by(worker_id='stopped').count() == 0
+            # Nothing changed anywhere: only the workers' versions are read
+            with assert_max_queries(1):
+                publish_presence_changes()
+        users = {user['id']: user['is_online'] for user in alice_http.get('/api/users').get_json()['users']}
+        assert users[bob_id] and not users[carol_id]
+        
+        # Bob closing the socket he also had here doesn't take him offline
+        alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+        bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+        with app.app_context():
+            publish_presence_changes()
+        bob_socket.disconnect()
+        alice_socket.get_received()
+        with app.app_context():
+            publish_presence_changes()
+            save_presence()
+            assert db.session.get(User, bob_id).is_online is True
+        assert not any(packet['name'] == 'presence' for packet in alice_socket.get_received())
+        
+        with app.app_context():
+            WorkerPresence.query.filter_by(worker_id='other').delete()
+            PresenceWorker.query.filter_by(id='other').update({'version': PresenceWorker.version + 1})
+            db.session.commit()
+            publish_presence_changes()
+        assert not presence.is_online(bob_id) and presence.is_online(alice_id)
+        alice_socket.disconnect()
+    finally:
+        app.config['PRESENCE_SHARED'] = False
+        presence.set_remote(())
+        with app.app_context():
+            PresenceWorker.query.delete()
+            WorkerPresence.query.delete()
+            db.session.commit()
+    print("✓ Presence is shared between workers")
+
+def _wait_for_event(client, name, timeout=5):
+    """Collect packets from a socket test client until ``name`` arrives"""
+    import time
+    deadline = time.time() + timeout
+    received = []
+    while time.time() < deadline:
+        received.extend(client.get_received())
+        matches = [packet for packet in received if packet['name'] == name]
+        if matches:
+            return matches[0]['args'][0]
+        time.sleep(0.01)
+    raise AssertionError(f'no {name} event within {timeout}s: {received}')
+
+def test_typing_events_are_coalesced_and_rate_limited():
+    """Keystroke bursts reach the recipient as one expiring event"""
+    from typing_state import TypingTracker
+    tracker = TypingTracker(ttl=6.0, rate=2.0, burst=3)
+    assert tracker.update(1, 2, True, now=0.0)
+    assert not tracker.update(1, 2, True, now=1.0)
+    assert tracker.update(1, 2, True, now=3.5)
+    assert tracker.update(1, 2, False, now=4.0)
+    # Stopping after the indicator expired on its own sends nothing
+    assert tracker.update(1, 2, True, now=10.0)
+    assert not tracker.update(1, 2, False, now=20.0)
+    assert [tracker.allow('sid', now=0.0) for _ in range(4)] == [True, True, True, False]
+    assert tracker.allow('sid', now=0.5)
+    assert tracker.stats()['rate_limited'] == 1
+    
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        bob_id = bob.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    
+    alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+    bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+    bob_socket.get_received()
+    for _ in range(20):
+        alice_socket.emit('typing', {'recipient_id': bob_id, 'is_typing': True})
+    events = [packet for packet in bob_socket.get_received() if packet['name'] == 'typing_status']
+    assert len(events) == 1
+    assert events[0]['args'][0]['is_typing'] is True
+    assert events[0]['args'][0]['expires_in'] > 0
+    alice_socket.disconnect()
+    bob_socket.disconnect()
+    print("✓ Typing events are coalesced and rate limited")
+
+def test_send_message_over_socket_and_http():
+    """Both send paths go through the write-behind queue and fan out once saved"""
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        alice_id, bob_id = alice.id, bob.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    
+    alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+    bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+    alice_socket.emit('send_message', {'client_id': 'c1', 'recipient_id': bob_id, 'content': 'over socket'})
+    ack = _wait_for_event(alice_socket, 'message_ack')
+    assert ack['client_id'] == 'c1' and ack['message']['content'] == 'over socket'
+    assert _wait_for_event(bob_socket, 'new_message')['message']['id'] == ack['message']['id']
+    
+    # A resend after a lost ack, over either path, returns the saved message
+    alice_socket.emit('send_message', {'client_id': 'c1', 'recipient_id': bob_id, 'content': 'over socket'})
+    assert _wait_for_event(alice_socket, 'message_ack')['message']['id'] == ack['message']['id']
+    response = alice_http.post('/api/send_message', json={
+        'client_id': 'c1', 'recipient_id': bob_id, 'content': 'over socket'
+    })
+    assert response.status_code == 200 and response.get_json()['id'] == ack['message']['id']
+    assert not any(packet['name'] == 'new_message' for packet in bob_socket.get_received())
+    from app import persist_messages
+    from message_writer import PendingMessage
+    twice = [PendingMessage(alice_id, bob_id, 'twice', client_id='c2') for _ in range(2)]
+    persist_messages(app, twice)
+    assert twice[0].payload['id'] == twice[1].payload['id'] and [p.duplicate for p in twice].count(True) == 1
+    with app.app_context():
+        assert Message.query.filter(Message.sender_id == alice_id, Message.client_id.isnot(None)).count() == 2
+    
+    response = alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'over http'})
+    assert response.status_code == 201 and response.get_json()['sender_id'] == alice_id
+    assert _wait_for_event(bob_socket, 'new_message')['message']['content'] == 'over http'
+    
+    response = alice_http.post('/api/send_message', json={'recipient_id': 10 ** 9, 'content': 'lost'})
+    assert response.status_code == 404
+    assert alice_http.post('/api/send_message', json=[1, 2]).status_code == 400
+    for payload in ('oops', None, 7, [1, 2]):
+        alice_socket.emit('send_message', payload)
+        assert _wait_for_event(alice_socket, 'message_ack') == {'client_id': None, 'error': 'Message must be a JSON object'}
+    alice_socket.disconnect()
+    bob_socket.disconnect()
+    print("✓ Messages sent over socket and HTTP are saved, acked and delivered")
+
+def test_message_batch_is_group_committed():
+    """A batch of queued messages costs a fixed number of statements, not one per message"""
+    from app import message_writer
+    from message_writer import PendingMessage
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        batch = [PendingMessage(alice.id, bob.id, f'burst {i}') for i in range(200)]
+        
+        # Recipient lookup, message insert, then the conversation summary upkeep
+        with assert_max_queries(6):
+            message_writer.write(batch)
+        
+        assert all(pending.error is None for pending in batch)
+        ids = [pending.payload['id'] for pending in batch]
+        assert len(set(ids)) == 200
+        assert Message.query.filter(Message.id.in_(ids)).count() == 200
+    print("✓ Queued messages are written with one bulk insert")
+
+def test_conversation_inbox_tracks_sends_and_reads():
+    """The inbox is ordered by recency and unread counts follow sends and reads"""
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        alice_id, bob_id, carol_id = alice.id, bob.id, carol.id
+        alice_http, bob_http, carol_http = (_logged_in_client(user) for user in (alice, bob, carol))
+    
+    bob_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'first'})
+    bob_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'second'})
+    carol_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'latest'})
+    
+    inbox = alice_http.get('/api/conversations').get_json()
+    assert [entry['user_id'] for entry in inbox['conversations']] == [carol_id, bob_id]
+    assert [entry['unread_count'] for entry in inbox['conversations']] == [1, 2]
+    assert inbox['conversations'][1]['last_message']['snippet'] == 'second'
+    assert str(bob_id) in inbox['users']
+    
+    first_id = alice_http.get(f'/api/messages/{bob_id}').get_json()['messages'][0]['id']
+    inbox = alice_http.get('/api/conversations').get_json()
+    assert [entry['unread_count'] for entry in inbox['conversations']] == [1, 2]
+    
+    assert alice_http.post(f'/api/messages/{bob_id}/read', json={'up_to': first_id}).status_code == 202
+    with app.app_context():
+        flush_read_receipts()
+    inbox = alice_http.get('/api/conversations').get_json()
+    assert [entry['unread_count'] for entry in inbox['conversations']] == [1, 1]
+    assert bob_http.get('/api/conversations').get_json()['conversations'][0]['unread_count'] == 0
+    print("✓ Conversation inbox follows sends and reads")
+
+def test_conversation_summaries_survive_concurrent_writers(monkeypatch):
+    """Writers racing to create a pair, or committing out of order, keep one current summary"""
+    import app as chat_app
+    from app import Conversation, ConversationMember
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        messages = [Message(sender_id=alice.id, recipient_id=bob.id, content=f'msg {i}') for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        update_conversations([messages[1]])
+        
+        # Another writer created the pair after this one looked for it
+        lookups = []
+        real_lookup = chat_app.load_conversation_ids
+        
+        def stale_lookup(keys):
+            lookups.append(keys)
+            return {} if len(lookups) == 1 else real_lookup(keys)
+        
+        monkeypatch.setattr(chat_app, 'load_conversation_ids', stale_lookup)
+        update_conversations([messages[2]])
+        monkeypatch.undo()
+        # An older batch committing late doesn't move the summary back
+        update_conversations([messages[0]])
+        db.session.commit()
+        
+        low_user_id, high_user_id = sorted((alice.id, bob.id))
+        conversation = Conversation.query.filter_by(low_user_id=low_user_id, high_user_id=high_user_id).one()
+        assert conversation.last_message_id == messages[2].id
+        unread = ConversationMember.query.filter_by(conversation_id=conversation.id, user_id=bob.id).one()
+        assert unread.unread_count == 3
+    print("✓ Conversation summaries survive concurrent writers")
+
+def test_read_receipts_are_batched_and_pushed_to_the_sender():
+    """Fetching history writes nothing; read watermarks are saved in one batch"""
+    from app import read_receipts
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        alice_id, bob_id, carol_id = alice.id, bob.id, carol.id
+        alice_http, bob_http, carol_http = (_logged_in_client(user) for user in (alice, bob, carol))
+    
+    for sender in (alice_http, carol_http):
+        for content in ('one', 'two'):
+            sender.post('/api/send_message', json={'recipient_id': bob_id, 'content': content})
+    
+    with app.app_context(), assert_max_queries(10) as statements:
+        bob_http.get(f'/api/messages/{alice_id}')
+    assert not [statement for statement in statements if not statement.lstrip().upper().startswith('SELECT')]
+    
+    alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+    bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+    alice_messages = bob_http.get(f'/api/messages/{alice_id}').get_json()['messages']
+    carol_messages = bob_http.get(f'/api/messages/{carol_id}').get_json()['messages']
+    bob_socket.emit('mark_read', {'user_id': alice_id, 'up_to': alice_messages[0]['id']})
+    bob_socket.emit('mark_read', {'user_id': alice_id, 'up_to': alice_messages[1]['id']})
+    bob_socket.emit('mark_read', {'user_id': alice_id, 'up_to': alice_messages[0]['id']})
+    bob_socket.emit('mark_read', {'user_id': carol_id, 'up_to': 10 ** 9})
+    for payload in ('oops', None, 7, [1, 2]):
+        assert bob_socket.emit('mark_read', payload, callback=True) == {'error': 'Read receipt must be a JSON object'}
+    # A watermark for someone bob has never talked to is dropped
+    alice_socket.emit('mark_read', {'user_id': carol_id, 'up_to': carol_messages[1]['id']})
+    assert len(read_receipts) == 3
+    
+    with app.app_context():
+        # Conversation lookup, mark messages read, member watermarks, sync log
+        with assert_max_queries(4):
+            flush_read_receipts()
+        assert Message.unread_from(alice_id, bob_id).count() == 0
+        assert Message.unread_from(carol_id, bob_id).count() == 0
+        assert Message.unread_from(carol_id, alice_id).count() == 0
+    
+    receipt = _wait_for_event(alice_socket, 'read_receipt')
+    assert receipt == {'user_id': bob_id, 'up_to': alice_messages[1]['id']}
+    # Capped at the conversation's latest message
+    assert bob_http.get('/api/conversations').get_json()['conversations'][0]['unread_count'] == 0
+    
+    bob_socket.emit('mark_read', {'user_id': alice_id, 'up_to': alice_messages[1]['id']})
+    with app.app_context(), assert_max_queries(1):
+        flush_read_receipts()
+    assert bob_http.post(f'/api/messages/{alice_id}/read', json={'up_to': 'all'}).status_code == 400
+    alice_socket.disconnect()
+    bob_socket.disconnect()
+    print("✓ Read receipts are batched and pushed to the sender")
+
+def test_group_messages_fan_out_through_one_room():
+    """A group message is stored once and emitted once, to the group's room"""
+    from app import emit_fanout, apply_membership_changes, group_members
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol, dave = (_make_user(name) for name in ('alice', 'bob', 'carol', 'dave'))
+        alice_id, bob_id, carol_id, dave_id = alice.id, bob.id, carol.id, dave.id
+        alice_http, bob_http, carol_http, dave_http = (
+            _logged_in_client(user) for user in (alice, bob, carol, dave)
+        )
+    
+    bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+    dave_socket = socketio.test_client(app, flask_test_client=dave_http)
+    response = alice_http.post('/api/conversations', json={'title': 'Trip', 'member_ids': [bob_id, carol_id]})
+    assert response.status_code == 201
+    group = response.get_json()
+    assert group['is_group'] and group['member_ids'] == sorted([alice_id, bob_id, carol_id])
+    assert _wait_for_event(bob_socket, 'group_added')['conversation']['id'] == group['id']
+    
+    cursor = bob_http.get('/api/sync').get_json()['cursor']
+    emits = emit_fanout.count(event='new_message')
+    response = alice_http.post('/api/send_message', json={'conversation_id': group['id'], 'content': 'hi all'})
+    assert response.status_code == 201 and response.get_json()['recipient_id'] is None
+    assert _wait_for_event(bob_socket, 'new_message')['message']['conversation_id'] == group['id']
+    assert emit_fanout.count(event='new_message') == emits + 1
+    assert not [packet for packet in dave_socket.get_received() if packet['name'] == 'new_message']
+    
+    entry = carol_http.get('/api/conversations').get_json()['conversations'][0]
+    assert (entry['id'], entry['title'], entry['user_id'], entry['unread_count']) == (group['id'], 'Trip', None, 1)
+    history = carol_http.get(f'/api/conversations/{group["id"]}/messages').get_json()
+    assert [m['content'] for m in history['messages']] == ['hi all']
+    assert str(alice_id) in history['users']
+    
+    up_to = history['messages'][0]['id']
+    assert carol_http.post(f'/api/conversations/{group["id"]}/read', json={'up_to': up_to}).status_code == 202
+    with app.app_context():
+        flush_read_receipts()
+    assert carol_http.get('/api/conversations').get_json()['conversations'][0]['unread_count'] == 0
+    receipt = _wait_for_event(bob_socket, 'read_receipt')
+    assert receipt == {'conversation_id': group['id'], 'receipts': [{'user_id': carol_id, 'up_to': up_to}]}
+    assert bob_http.get(f'/api/sync?since={cursor}').get_json()['read_receipts'] == [
+        {'kind': 'read', 'conversation_id': group['id'], 'receipts': [{'user_id': carol_id, 'up_to': up_to}]}
+    ]
+    too_many = list(range(1, app.config['GROUP_MAX_MEMBERS'] + 2))
+    assert alice_http.post(f'/api/conversations/{group["id"]}/members', json={'member_ids': too_many}).status_code == 400
+    
+    # Outsiders can neither read nor write, and leaving stops delivery
+    assert dave_http.get(f'/api/conversations/{group["id"]}/messages').status_code == 404
+    assert dave_http.post('/api/send_message', json={'conversation_id': group['id'], 'content': 'x'}).status_code == 404
+    
+    # Another worker applies the logged join: its stale cache goes and dave's socket joins the room
+    room = f'conversation_{group["id"]}'
+    dave_sid = socketio.server.manager.sid_from_eio_sid(dave_socket.eio_sid, '/')
+    with app.app_context():
+        changes = apply_membership_changes(None)
+    stale = group_members.get(group['id'])
+    assert alice_http.post(f'/api/conversations/{group["id"]}/members', json={'member_ids': [dave_id]}).status_code == 200
+    group_members.set(group['id'], stale)
+    socketio.server.leave_room(dave_sid, room)
+    with app.app_context():
+        changes = apply_membership_changes(changes)
+    assert dave_sid in dict(socketio.server.manager.get_participants('/', room))
+    for payload in ('oops', None, 7, [1, 2]):
+        assert dave_socket.emit('join_conversation', payload, callback=True) == \
+            {'error': 'Join request must be a JSON object'}
+    assert dave_http.post('/api/send_message', json={'conversation_id': group['id'], 'content': 'hi'}).status_code == 201
+    
+    assert bob_http.post(f'/api/conversations/{group["id"]}/leave').status_code == 204
+    assert _wait_for_event(bob_socket, 'group_removed') == {'conversation_id': group['id']}
+    alice_http.post('/api/send_message', json={'conversation_id': group['id'], 'content': 'bye bob'})
+    assert not [packet for packet in bob_socket.get_received() if packet['name'] == 'new_message']
+    
+    # A worker that did not handle the leave drops bob's sockets when it catches up
+    bob_sid = socketio.server.manager.sid_from_eio_sid(bob_socket.eio_sid, '/')
+    socketio.server.enter_room(bob_sid, room)
+    with app.app_context():
+        apply_membership_changes(changes)
+    assert bob_sid not in dict(socketio.server.manager.get_participants('/', room))
+    bob_socket.disconnect()
+    dave_socket.disconnect()
+    print("✓ Group messages are stored once and fanned out through the group room")
+
+def test_attachments_stream_dedupe_and_serve_ranges():
+    """Uploads are stored once per content; downloads honour Range and caching"""
+    from app import attachment_store
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        bob_id = bob.id
+        alice_http, bob_http, carol_http = (_logged_in_client(user) for user in (alice, bob, carol))
+    
+    body = os.urandom(200 * 1024)
+    first = alice_http.post('/api/attachments?filename=../photo.png', data=body, content_type='image/png')
+    again = carol_http.post('/api/attachments?filename=copy.png', data=body, content_type='image/png')
+    assert first.status_code == again.status_code == 201
+    attachment = first.get_json()
+    assert attachment['filename'] == 'photo.png' and attachment['size'] == len(body)
+    assert again.get_json()['sha256'] == attachment['sha256']
+    stored = os.path.dirname(attachment_store.path(attachment['sha256']))
+    assert os.listdir(stored) == [attachment['sha256']]
+    assert alice_http.post('/api/attachments', data=b'', content_type='text/plain').status_code == 400
+    
+    # Only the uploader and the people it is sent to can download it
+    assert bob_http.get(attachment['url']).status_code == 404
+    response = alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'attachment_id': attachment['id']})
+    assert response.status_code == 201 and response.get_json()['attachment_id'] == attachment['id']
+    assert carol_http.post('/api/send_message', json={
+        'recipient_id': bob_id, 'attachment_id': attachment['id']
+    }).status_code == 404
+    history = bob_http.get(f'/api/messages/{response.get_json()["sender_id"]}').get_json()
+    assert history['attachments'][str(attachment['id'])]['filename'] == 'photo.png'
+    
+    response = bob_http.get(attachment['url'])
+    assert response.status_code == 200 and response.data == body
+    assert response.headers['ETag'] == f'"{attachment["sha256"]}"'
+    assert {'private', 'immutable'} <= set(response.headers['Cache-Control'].replace(' ', '').split(','))
+    assert bob_http.get(attachment['url'], headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    partial = bob_http.get(attachment['url'], headers={'Range': 'bytes=100-199'})
+    assert partial.status_code == 206 and partial.data == body[100:200]
+    assert carol_http.get(attachment['url']).status_code == 404
+    
+    max_size, app.config['ATTACHMENT_MAX_SIZE'] = app.config['ATTACHMENT_MAX_SIZE'], 1024
+    try:
+        assert alice_http.post('/api/attachments', data=body, content_type='image/png').status_code == 413
+    finally:
+        app.config['ATTACHMENT_MAX_SIZE'] = max_size
+    assert os.listdir(os.path.join(attachment_store.root, 'incoming')) == []
+    print("✓ Attachments are deduplicated, access-checked and served with ranges")
+
+def test_rate_limits_reject_before_any_database_work():
+    """Routes and socket events have their own budgets; rejections cost no SQL"""
+    from app import rate_limiter
+    from rate_limit import MemoryBackend, RateLimiter
+    limiter = RateLimiter(limits={'burst': '3/second', 'free': None}, default='1/minute')
+    assert [limiter.hit('burst', 'a', now=0) for _ in range(4)] == [0, 0, 0, 0.334]
+    assert limiter.hit('burst', 'a', now=0.5) == 0 and limiter.hit('burst', 'b', now=0) == 0
+    assert limiter.hit('free', 'a') == 0 and limiter.hit('other', 'a', now=0) == 0
+    assert limiter.hit('other', 'a', now=1) == 59.0
+    
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        bob_id = bob.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    
+    app.config['RATELIMIT_ENABLED'] = True
+    rate_limiter.configure(MemoryBackend(), {'main.send_message': '2/minute', 'socket.send_message': '1/minute'})
+    try:
+        for content in ('one', 'two'):
+            response = alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': content})
+            assert response.status_code == 201
+        with app.app_context(), assert_max_queries(0):
+            response = alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'three'})
+        assert response.status_code == 429 and int(response.headers['Retry-After']) in (29, 30)
+        # Budgets are per user
+        assert bob_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'hi'}).status_code == 201
+        
+        socket = socketio.test_client(app, flask_test_client=alice_http)
+        socket.emit('send_message', {'client_id': 'a', 'recipient_id': bob_id, 'content': 'socket one'})
+        assert _wait_for_event(socket, 'message_ack')['client_id'] == 'a'
+        socket.emit('send_message', {'client_id': 'b', 'recipient_id': bob_id, 'content': 'socket two'})
+        limited = _wait_for_event(socket, 'rate_limited')
+        assert (limited['event'], limited['client_id']) == ('send_message', 'b') and 59 < limited['retry_after'] <= 60
+        socket.disconnect()
+    finally:
+        app.config['RATELIMIT_ENABLED'] = False
+        rate_limiter.configure(MemoryBackend(), app.config['RATELIMIT_LIMITS'], app.config['RATELIMIT_DEFAULT'])
+    print("✓ Rate limits apply per route, event and user before any database work")
+
+def test_reads_go_to_a_replica_except_right_after_a_write():
+    """Replica-routed views read the replica, but a user who just sent reads the primary"""
+    import sqlite3
+    from sqlalchemy import create_engine
+    from app import group_members, recent_writers, user_groups
+    with app.app_context():
+        db.create_all()
+        if db.engine.dialect.name != 'sqlite':
+            return
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        alice_id, bob_id = alice.id, bob.id
+        alice_http, bob_http, carol_http = (_logged_in_client(user) for user in (alice, bob, carol))
+        primary_path = db.engine.url.database
+    
+    alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'before'})
+    # A copy taken now stands in for a replica that is lagging behind
+    replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+    with sqlite3.connect(primary_path) as source, sqlite3.connect(replica_path) as target:
+        source.backup(target)
+    replica = create_engine(f'sqlite:///{replica_path}')
+    app.extensions['read_replicas'] = [replica]
+    try:
+        recent_writers.clear()
+        alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'after'})
+        
+        history = bob_http.get(f'/api/messages/{alice_id}').get_json()['messages']
+        assert [message['content'] for message in history] == ['before']
+        # The sender sees their own message although the replica lacks it
+        history = alice_http.get(f'/api/messages/{bob_id}').get_json()['messages']
+        assert [message['content'] for message in history] == ['before', 'after']
+        
+        recent_writers.clear()
+        history = alice_http.get(f'/api/messages/{bob_id}').get_json()['messages']
+        assert [message['content'] for message in history] == ['before']
+        # Views that write, and everything not marked for replicas, use the primary
+        assert bob_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'reply'}).status_code == 201
+        with app.app_context():
+            assert Message.query.filter_by(content='reply').count() == 1
+        
+        # Membership is cached across requests, so it is never read from the replica
+        group_id = carol_http.post('/api/conversations', json={'member_ids': [bob_id]}).get_json()['id']
+        group_members.clear()
+        user_groups.clear()
+        recent_writers.clear()
+        response = bob_http.get(f'/api/conversations/{group_id}/messages')
+        assert response.status_code == 200 and response.get_json()['messages'] == []
+        assert bob_http.post('/api/send_message', json={'conversation_id': group_id, 'content': 'hi'}).status_code == 201
+    finally:
+        app.extensions['read_replicas'] = []
+        replica.dispose()
+    print("✓ Reads go to the replica except for users who just wrote")
+
+def test_search_is_ranked_scoped_and_indexed():
+    """/api/search finds words in the user's own conversations, best match first"""
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        alice_id, bob_id, carol_id = alice.id, bob.id, carol.id
+        db.session.add_all([
+            Message(sender_id=alice_id, recipient_id=bob_id, content='The quick brown fox'),
+            Message(sender_id=bob_id, recipient_id=alice_id, content='fox fox fox, all foxes'),
+            Message(sender_id=alice_id, recipient_id=carol_id, content='<b>brown</b> bread'),
+            Message(sender_id=bob_id, recipient_id=carol_id, content='a private fox'),
+        ])
+        db.session.commit()
+        
+        if db.engine.dialect.name == 'sqlite':
+            plan = ' '.join(row[-1] for row in db.session.execute(text(
+                "EXPLAIN QUERY PLAN SELECT rowid FROM message_fts WHERE message_fts MATCH 'fox'"
+            ))).lower()
+            assert 'virtual table' in plan, plan
+        alice_http = _logged_in_client(alice)
+    
+    results = alice_http.get('/api/search?q=fox').get_json()
+    assert [r['message']['content'] for r in results['results']] == ['fox fox fox, all foxes', 'The quick brown fox']
+    assert '<mark>' in results['results'][0]['snippet'] and str(bob_id) in results['users']
+    
+    # The last word matches as a prefix; markup in messages is escaped
+    results = alice_http.get('/api/search?q=bro').get_json()['results']
+    assert len(results) == 2
+    assert '&lt;b&gt;' in [r for r in results if r['message']['recipient_id'] == carol_id][0]['snippet']
+    
+    assert len(alice_http.get(f'/api/search?q=brown&user_id={carol_id}').get_json()['results']) == 1
+    paged = alice_http.get('/api/search?q=fox&limit=1').get_json()
+    assert len(paged['results']) == 1 and paged['has_more'] is True
+    assert alice_http.get('/api/search?q="*)(').get_json() == {'results': [], 'users': {}, 'has_more': False}
+    print("✓ Message search is ranked, scoped and indexed")
+
+def test_backfill_conversations():
+    """The backfill command summarizes history written before conversations existed"""
+    from database_setup import backfill_conversations
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        db.session.add_all([
+            Message(sender_id=alice.id, recipient_id=bob.id, content='old'),
+            Message(sender_id=alice.id, recipient_id=bob.id, content='older still unread')
+        ])
+        db.session.commit()
+        
+        backfill_conversations()
+        
+        conversation = Conversation.query.filter_by(
+            low_user_id=min(alice.id, bob.id), high_user_id=max(alice.id, bob.id)
+        ).one()
+        assert conversation.last_message_snippet == 'older still unread'
+        assert ConversationMember.query.filter_by(conversation_id=conversation.id, user_id=bob.id).one().unread_count == 2
+        assert ConversationMember.query.filter_by(conversation_id=conversation.id, user_id=alice.id).one().unread_count == 0
+    print("✓ Backfill builds conversation summaries")
+
+def test_sync_returns_only_changes_since_cursor():
+    """A reconnecting client gets new messages and read receipts, nothing older"""
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        alice_id, bob_id = alice.id, bob.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    
+    alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'before'})
+    cursor = alice_http.get('/api/sync').get_json()['cursor']
+    
+    alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'missed'})
+    bob_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'reply'})
+    missed_id = bob_http.get(f'/api/messages/{alice_id}').get_json()['messages'][-2]['id']
+    bob_http.post(f'/api/messages/{alice_id}/read', json={'up_to': missed_id})
+    with app.app_context():
+        flush_read_receipts()
+    
+    delta = alice_http.get(f'/api/sync?since={cursor}').get_json()
+    assert [m['content'] for m in delta['messages']] == ['missed', 'reply']
+    assert delta['read_receipts'] == [{'kind': 'read', 'user_id': bob_id, 'up_to': delta['messages'][0]['id']}]
+    assert str(bob_id) in delta['users'] and delta['has_more'] is False
+    
+    again = alice_http.get(f'/api/sync?since={delta["cursor"]}').get_json()
+    assert again['messages'] == [] and again['read_receipts'] == []
+    alice_http.post('/api/send_message', json={'recipient_id': alice_id, 'content': 'note to self'})
+    notes = alice_http.get(f'/api/sync?since={delta["cursor"]}').get_json()
+    assert [m['content'] for m in notes['messages']] == ['note to self']
+    
+    paged = alice_http.get(f'/api/sync?since={cursor}&limit=1').get_json()
+    assert [m['content'] for m in paged['messages']] == ['missed'] and paged['has_more'] is True
+    assert alice_http.get('/api/sync?since=garbage').status_code == 400
+    print("✓ Delta sync returns only what changed since the cursor")
+
+def test_user_directory_is_cached_and_conditional():
+    """/api/users pages by prefix, hides emails and answers 304 until something changes"""
+    from app import directory
+    with app.app_context():
+        db.create_all()
+        tag = uuid.uuid4().hex[:6]
+        viewer = _make_user(f'dir{tag}')
+        for name in ('ann', 'anton', 'bert'):
+            user = User(username=f'dir{tag}_{name}', email=f'{tag}{name}@example.com')
+            user.set_password('password123')
+            db.session.add(user)
+        db.session.commit()
+        client = _logged_in_client(viewer)
+    
+    response = client.get(f'/api/users?q=DIR{tag}_an&limit=1')
+    page = response.get_json()
+    assert [user['username'] for user in page['users']] == [f'dir{tag}_ann'] and page['has_more']
+    assert 'email' not in page['users'][0]
+    assert client.get(f'/api/users?q=dir{tag}_an&limit=1&offset=1').get_json()['users'][0]['username'] == f'dir{tag}_anton'
+    assert [user['username'] for user in client.get(f'/api/users?q=dir{tag}').get_json()['users']] == \
+        [f'dir{tag}_ann', f'dir{tag}_anton', f'dir{tag}_bert']
+    
+    etag = response.headers['ETag']
+    misses = directory.misses
+    cached = client.get(f'/api/users?q=dir{tag}_an&limit=1', headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and directory.misses == misses
+    # The ETag comes from the page, so a reload that changes nothing still matches
+    directory.invalidate()
+    assert client.get(f'/api/users?q=dir{tag}_an&limit=1', headers={'If-None-Match': etag}).status_code == 304
+    
+    with app.app_context():
+        user = User(username=f'dir{tag}_andy', email=f'{tag}andy@example.com')
+        user.set_password('password123')
+        db.session.add(user)
+        db.session.commit()
+    fresh = client.get(f'/api/users?q=dir{tag}_an&limit=1', headers={'If-None-Match': etag})
+    assert fresh.status_code == 200 and fresh.get_json()['users'][0]['username'] == f'dir{tag}_andy'
+    
+    # Another worker's change skips this worker's session hooks; the TTL bounds it
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'dir{tag}_amy', 'email': f'{tag}amy@example.com', 'password_hash': '!'}
+        ])
+        db.session.commit()
+    assert client.get(f'/api/users?q=dir{tag}_am').get_json()['users'] == []
+    ttl, directory.ttl = directory.ttl, 0
+    try:
+        assert [user['username'] for user in client.get(f'/api/users?q=dir{tag}_am').get_json()['users']] == \
+            [f'dir{tag}_amy']
+    finally:
+        directory.ttl = ttl
+    print("✓ User directory is cached, paged and conditional")
+
+def test_load_user_is_cached_until_the_user_changes():
+    """Authenticated requests reuse a user snapshot until the row is updated"""
+    from app import user_cache
+    with app.app_context():
+        db.create_all()
+        alice = _make_user('alice')
+        alice_id = alice.id
+        client = _logged_in_client(alice)
+    
+    client.get('/api/stats')
+    hits = user_cache.hits
+    with app.app_context():
+        with assert_max_queries(0):
+            stats = client.get('/api/stats').get_json()
+    assert user_cache.hits == hits + 1 and stats['user_cache']['hits'] >= 1
+    
+    with app.app_context():
+        db.session.get(User, alice_id).status = 'Updated status'
+        db.session.commit()
+    assert user_cache.get(alice_id) is None
+    html = client.get('/chat').get_data(as_text=True)
+    assert 'Updated status' in html
+    
+    client.get('/logout')
+    assert user_cache.get(alice_id) is None
+    assert client.get('/api/stats').status_code == 302
+    print("✓ load_user serves cached snapshots and drops them on change")
+
+def _query_plan(statement):
+    """Return the database's plan for ``statement`` as one lowercase string"""
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+        return ' | '.join(row[-1] for row in rows).lower()
+    # Tiny test tables make a sequential scan look cheapest, so rule it out
+    db.session.execute(text('SET LOCAL enable_seqscan = off'))
+    rows = db.session.execute(text(f'EXPLAIN {compiled}')).all()
+    return ' | '.join(row[0] for row in rows).lower()
+
+def _assert_uses_index(statement):
+    plan = _query_plan(statement)
+    assert 'scan message' not in plan and 'seq scan on message' not in plan, plan
+    return plan
+
+def test_metrics_cover_requests_queries_and_socket_events(caplog):
+    """/metrics reports route latency, SQL per request and socket events"""
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        bob_id = bob.id
+        alice_http = _logged_in_client(alice)
+    
+    alice_http.get(f'/api/messages/{bob_id}')
+    alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+    alice_socket.emit('typing', {'recipient_id': bob_id, 'is_typing': True})
+    
+    body = app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{endpoint="main.get_messages",method="GET"}' in body
+    assert 'http_requests_total{endpoint="main.get_messages",method="GET",status="200"}' in body
+    assert 'http_request_sql_queries_bucket{endpoint="main.get_messages",le="+Inf"}' in body
+    assert 'socketio_event_duration_seconds_count{event="typing"}' in body
+    assert 'socketio_emit_fanout_rooms_count{event="typing_status"}' in body
+    assert 'socketio_rooms{kind="user"}' in body
+    connected = [line for line in body.splitlines() if line.startswith('socketio_connected_sockets ')]
+    assert float(connected[0].split()[1]) >= 1
+    alice_socket.disconnect()
+    
+    app.config['SLOW_QUERY_THRESHOLD'] = 0
+    try:
+        with caplog.at_level('WARNING'):
+            alice_http.get(f'/api/messages/{bob_id}')
+    finally:
+        app.config['SLOW_QUERY_THRESHOLD'] = 0.25
+    assert any('Slow query' in record.getMessage() for record in caplog.records)
+    
+    app.config['METRICS_TOKEN'] = 'secret'
+    try:
+        assert app.test_client().get('/metrics').status_code == 401
+        assert app.test_client().get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+    finally:
+        app.config['METRICS_TOKEN'] = None
+    print("✓ Metrics cover requests, queries and socket events")
+
+def test_connections_go_back_to_the_pool():
+    """Socket handlers and HTTP requests return their connections when they finish"""
+    from app import user_cache
+    from config import engine_options
+    assert engine_options('sqlite:///chat.db') == {}
+    assert engine_options('postgresql://db/chat')['pool_pre_ping'] is True
+    
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        bob_id = bob.id
+        alice_http = _logged_in_client(alice)
+        pool = db.engine.pool
+    
+    # Make every handler load the user from the database
+    user_cache.clear()
+    alice_socket = socketio.test_client(app, flask_test_client=alice_http)
+    alice_socket.emit('send_message', {'client_id': 'p1', 'recipient_id': bob_id, 'content': 'pooled'})
+    _wait_for_event(alice_socket, 'message_ack')
+    alice_socket.emit('mark_read', {'user_id': bob_id, 'up_to': 1})
+    alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'pooled too'})
+    alice_socket.disconnect()
+    assert pool.checkedout() == 0
+    
+    body = app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'db_pool_connections{state="checked_out"} 0' in body
+    assert 'db_pool_events_total{event="checkout"}' in body
+    print("✓ Connections go back to the pool")
+
+def test_json_serializer_writes_what_the_clients_expect():
+    """Fast-path JSON keeps ISO timestamps and string keys, over HTTP and sockets"""
+    import json
+    from datetime import datetime
+    import serializer
+    payload = {'at': datetime(2024, 1, 2, 3, 4, 5, 6), 'users': {7: {'name': 'zoë'}}, 'none': None}
+    expected = {'at': '2024-01-02T03:04:05.000006', 'users': {'7': {'name': 'zoë'}}, 'none': None}
+    assert json.loads(serializer.dumps(payload, separators=(',', ':'))) == expected
+    assert serializer.loads(serializer.dumps_bytes(payload)) == expected
+    
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        bob_id = bob.id
+        alice_http, bob_http = _logged_in_client(alice), _logged_in_client(bob)
+    
+    bob_socket = socketio.test_client(app, flask_test_client=bob_http)
+    sent = alice_http.post('/api/send_message', json={'recipient_id': bob_id, 'content': 'hi'}).get_json()
+    datetime.fromisoformat(sent['timestamp'])
+    assert _wait_for_event(bob_socket, 'new_message')['message']['timestamp'] == sent['timestamp']
+    page = alice_http.get(f'/api/messages/{bob_id}').get_json()
+    assert page['messages'][-1]['timestamp'] == sent['timestamp']
+    assert isinstance(page['users'][str(bob_id)]['last_seen'], str)
+    bob_socket.disconnect()
+    print(f"✓ JSON goes through {serializer.BACKEND} and keeps its shape")
+
+def test_benchmark_reports_every_scenario():
+    """A tiny benchmark run completes without errors and reports each scenario"""
+    from benchmark import SCENARIOS, run_benchmark
+    report = run_benchmark(app, users=4, messages=40, clients=2, iterations=2, group_sizes=[3],
+                           export_sizes=[50])
+    assert set(report['scenarios']) == set(SCENARIOS)
+    for name, result in report['scenarios'].items():
+        assert result['calls'] == 4 and result['errors'] == 0, (name, result)
+        assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'] <= result['max_ms']
+    storm = report['login_storm']
+    assert storm['logins']['calls'] == 4 and storm['logins']['errors'] == 0
+    assert storm['probe_idle']['samples'] > 0
+    assert report['group_fanout']['3']['samples'] == 2 and report['group_fanout']['3']['missed_deliveries'] == 0
+    assert report['rate_limit']['allowed_us'] > 0 and report['rate_limit']['rejected_us'] > 0
+    assert report['export']['50']['messages'] == 50
+    print("✓ Benchmark runs every scenario")
+
+def test_login_upgrades_outdated_password_hashes():
+    """A successful login re-hashes a password made with an older method or cost"""
+    import passwords
+    with app.app_context():
+        db.create_all()
+        user = _make_user('alice')
+        user_id, email = user.id, user.email
+
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+    try:
+        client = app.test_client()
+        assert client.post('/login', data={'email': email, 'password': 'wrong'}).status_code == 200
+        with app.app_context():
+            assert db.session.get(User, user_id).password_hash.startswith('pbkdf2:sha256:1000$')
+        assert client.post('/login', data={'email': email, 'password': 'password123'}).status_code == 302
+        with app.app_context():
+            stored = db.session.get(User, user_id).password_hash
+    finally:
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    assert stored.startswith('pbkdf2:sha256:2000$')
+    assert passwords.verify(stored, 'password123', 'pbkdf2:sha256:2000') == (True, None)
+    print("✓ Logins upgrade outdated password hashes")
+
+def test_create_app_does_no_database_work():
+    """A worker starts even when the database is unreachable; schema setup is a separate command"""
+    from benchmark import measure_startup
+    env = dict(os.environ, DATABASE_URL='sqlite:////nonexistent/startup.db', FLASK_ENV='production')
+    startup = measure_startup(runs=1, env=env)
+    assert startup['runs'] == 1 and startup['import_ms'] > 0 and startup['create_app_ms'] > 0
+    print(f"✓ Cold start: {startup['import_ms']} ms import, {startup['create_app_ms']} ms create_app")
+
+def test_hot_queries_use_indexes():
+    """History, unread-marking and inbox queries must not scan the message table"""
+    from sqlalchemy import update
+    with app.app_context():
+        db.create_all()
+        history = Message.between(1, 2).filter(Message.id < 100).order_by(Message.id.desc()).limit(50)
+        _assert_uses_index(history.statement)
+        
+        unread = Message.unread_from(2, 1).statement.whereclause
+        _assert_uses_index(update(Message).where(unread).values(is_read=True))
+        
+        inbox = Message.query.filter(Message.recipient_id == 1).order_by(Message.id.desc()).limit(50)
+        _assert_uses_index(inbox.statement)
+        db.session.rollback()
+    print("✓ Hot message queries are served by indexes")
+
+def test_old_messages_are_archived_and_still_paged():
+    """The archive command moves old messages out in batches; history pages on into the archive"""
+    from datetime import datetime, timedelta
+    from app import MessageArchive
+    from database_setup import archive_messages
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        old = datetime.utcnow() - timedelta(days=200)
+        db.session.add_all([
+            Message(sender_id=alice.id, recipient_id=bob.id, content=f'msg {i}', timestamp=old) for i in range(3)
+        ])
+        db.session.add_all([Message(sender_id=alice.id, recipient_id=bob.id, content=f'msg {i}') for i in (3, 4)])
+        db.session.commit()
+        alice_id, bob_id = alice.id, bob.id
+        client = _logged_in_client(alice)
+
+        assert archive_messages(retention_days=90, batch_size=2) >= 3
+        assert [m.content for m in Message.between(alice_id, bob_id).order_by(Message.id)] == ['msg 3', 'msg 4']
+        assert MessageArchive.between(alice_id, bob_id).count() == 3
+        _assert_uses_index(MessageArchive.between(alice_id, bob_id).filter(MessageArchive.id < 100)
+                           .order_by(MessageArchive.id.desc()).limit(50).statement)
+
+    page = client.get(f'/api/messages/{bob_id}?limit=2').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 3', 'msg 4'] and page['has_more']
+    page = client.get(f'/api/messages/{bob_id}?limit=2&before_id={page["next_cursor"]}').get_json()
+    assert [m['content'] for m in page['messages']] == ['msg 1', 'msg 2'] and page['has_more']
+    oldest = client.get(f'/api/messages/{bob_id}?limit=2&before_id={page["next_cursor"]}').get_json()
+    assert [m['content'] for m in oldest['messages']] == ['msg 0'] and not oldest['has_more']
+    newer = client.get(f'/api/messages/{bob_id}?after_id={oldest["messages"][0]["id"]}').get_json()
+    assert [m['content'] for m in newer['messages']] == ['msg 1', 'msg 2', 'msg 3', 'msg 4']
+    print("✓ Old messages are archived and history pages into the archive")
+
+def test_export_streams_the_whole_conversation():
+    """Exports run from the archive through the hot table, one chunk per fetched batch"""
+    import csv
+    import json
+    from datetime import datetime, timedelta
+    from database_setup import archive_messages, export_conversation
+    with app.app_context():
+        db.create_all()
+        alice, bob, carol = _make_user('alice'), _make_user('bob'), _make_user('carol')
+        old = datetime.utcnow() - timedelta(days=200)
+        db.session.add_all([
+            Message(sender_id=alice.id, recipient_id=bob.id, content=f'old {i}', timestamp=old) for i in range(3)
+        ])
+        db.session.add(Message(sender_id=carol.id, recipient_id=bob.id, content='not theirs'))
+        db.session.add_all([
+            Message(sender_id=bob.id, recipient_id=alice.id, content=f'new, "quoted" {i}') for i in range(4)
+        ])
+        db.session.commit()
+        archive_messages(retention_days=90)
+        alice_id, bob_id = alice.id, bob.id
+        client = _logged_in_client(alice)
+    expected = [f'old {i}' for i in range(3)] + [f'new, "quoted" {i}' for i in range(4)]
+    
+    batch_size, app.config['EXPORT_BATCH_SIZE'] = app.config['EXPORT_BATCH_SIZE'], 2
+    try:
+        response = client.get(f'/api/export/{bob_id}', buffered=False)
+        assert response.is_streamed and response.mimetype == 'application/x-ndjson'
+        assert 'attachment' in response.headers['Content-Disposition']
+        chunks = [chunk for chunk in response.response if chunk]
+        response.close()
+        # Two archived rows, one, then two hot rows at a time
+        assert len(chunks) == 4
+        lines = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        assert [line['content'] for line in lines] == expected
+        assert [line['id'] for line in lines] == sorted(line['id'] for line in lines)
+        
+        rows = list(csv.DictReader(client.get(f'/api/export/{bob_id}?format=csv').get_data(as_text=True).splitlines()))
+        assert [row['content'] for row in rows] == expected and rows[0]['sender_id'] == str(alice_id)
+        assert client.get(f'/api/export/{bob_id}?format=xml').status_code == 400
+        
+        path = os.path.join(tempfile.mkdtemp(), 'export.csv')
+        with app.app_context():
+            assert export_conversation(bob_id, alice_id, path) == len(expected)
+        with open(path, newline='') as exported:
+            assert [row['content'] for row in csv.DictReader(exported)] == expected
+    finally:
+        app.config['EXPORT_BATCH_SIZE'] = batch_size
+    print("✓ Conversations export as streamed NDJSON and CSV")
+
+def test_migrate_adds_conversation_keys():
+    """The migrate command upgrades a pre-index message table in place"""
+    from database_setup import migrate_database
+    with app.app_context():
+        db.create_all()
+        alice, bob = _make_user('alice'), _make_user('bob')
+        Message.__table__.drop(db.engine)
+        db.session.execute(text(
+            'CREATE TABLE message (id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, '
+            'recipient_id INTEGER NOT NULL, content TEXT NOT NULL, timestamp TIMESTAMP, is_read BOOLEAN)'
+        ))
+        db.session.execute(text(
+            'INSERT INTO message (sender_id, recipient_id, content, is_read) VALUES (:s, :r, :c, false)'
+        ), {'s': bob.id, 'r': alice.id, 'c': 'legacy'})
+        db.session.commit()
+        
+        migrate_database()
+        
+        message = Message.query.filter_by(content='legacy').one()
+        assert (message.low_user_id, message.high_user_id) == (alice.id, bob.id)
+        index_names = {index['name'] for index in inspect(db.engine).get_indexes('message')}
+        assert {index.name for index in Message.__table__.indexes} <= index_names
+        # Existing history is indexed for search, and new messages follow
+        from app import search_messages
+        db.session.add(Message(sender_id=alice.id, recipient_id=bob.id, content='legacy reply'))
+        db.session.commit()
+        assert len(search_messages(alice.id, 'legacy')) == 2
+        # recipient_id is optional now, for group messages
+        group = Conversation(is_group=True)
+        db.session.add(group)
+        db.session.flush()
+        db.session.add(Message(sender_id=alice.id, conversation_id=group.id, content='legacy group'))
+        db.session.commit()
+        assert Message.query.filter_by(content='legacy group').one().recipient_id is None
+    print("✓ Migration backfills conversation keys and creates indexes")
+
 def show_database_info():
     """Show database configuration info"""
     database_url = os.environ.get('DATABASE_URL', 'Not set')
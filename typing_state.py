@@ -0,0 +1,87 @@
+"""
+Server-side typing indicator state.
+
+Clients may emit ``typing`` on every keystroke; only state changes reach the
+recipient. A forwarded "is typing" carries an expiry, so the recipient clears
+it on its own and no stop frame is needed. Each connection also gets a token
+bucket so one client cannot flood the server.
+"""
+
+import threading
+import time
+
+
+class TypingTracker:
+    """Per-(sender, recipient) typing state with dedup, expiry and a per-socket budget
+
+    :param ttl: Seconds a forwarded "is typing" stays valid at the recipient.
+    :param rate: Typing events each connection may send per second.
+    :param burst: How many events a connection may send at once.
+    """
+
+    def __init__(self, ttl=6.0, rate=2.0, burst=5):
+        self.ttl = ttl
+        self.rate = rate
+        self.burst = burst
+        self.received = 0
+        self.forwarded = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._typing = {}
+        self._budgets = {}
+        self._next_sweep = 0.0
+
+    @property
+    def refresh(self):
+        """Re-announce a still-typing sender halfway through the expiry"""
+        return self.ttl / 2
+
+    def allow(self, sid, now=None):
+        """Spend one token from ``sid``'s bucket; False if it is empty"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.received += 1
+            tokens, updated = self._budgets.get(sid, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._budgets[sid] = (tokens, now)
+                self.rate_limited += 1
+                return False
+            self._budgets[sid] = (tokens - 1, now)
+            return True
+
+    def update(self, sender_id, recipient_id, is_typing, now=None):
+        """Record a typing event; True if the recipient should hear about it"""
+        now = time.monotonic() if now is None else now
+        key = (sender_id, recipient_id)
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            last = self._typing.get(key)
+            if is_typing:
+                if last is not None and now - last < self.refresh:
+                    return False
+                self._typing[key] = now
+            else:
+                self._typing.pop(key, None)
+                # A stop only matters while the recipient still shows the indicator
+                if last is None or now - last >= self.ttl:
+                    return False
+            self.forwarded += 1
+            return True
+
+    def stop(self, sender_id, recipient_id):
+        """Forget typing state, e.g. once the sender's message went out"""
+        with self._lock:
+            self._typing.pop((sender_id, recipient_id), None)
+
+    def forget(self, sid):
+        with self._lock:
+            self._budgets.pop(sid, None)
+
+    def _sweep(self, now):
+        self._typing = {key: at for key, at in self._typing.items() if now - at < self.ttl}
+        self._next_sweep = now + self.ttl
+
+    def stats(self):
+        return {'received': self.received, 'forwarded': self.forwarded, 'rate_limited': self.rate_limited}